@@ -0,0 +1 @@
+"""Benchmarks of maruberu (run as `python -m benchmarks.<name>` in repository root)."""
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""End-to-end HTTP benchmark of ring pipeline.
+
+Start maruberu application in-process with no-op bell, then drive `GET /`,
+`GET /resource/<token>/` and `POST /resource/<token>/` with concurrent API clients.
+
+    python -m benchmarks.bench_http --output baseline.json
+    python -m benchmarks.bench_http --compare baseline.json
+
+REDIS backend uses `--redis` address if specified, or `fakeredis` as in-process stand-in.
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime
+import json
+import logging
+import statistics
+import time
+from typing import Dict, List, Optional
+
+from tornado import httpclient
+from tornado import httpserver
+from tornado import ioloop
+from tornado import testing
+
+import maruberu
+from maruberu.infrastructure import BellScheduler, MaruBell, MemoryStorage
+from maruberu.main import make_app
+from maruberu.models import BaseStorage, BellResource, DataBaseAddress
+from maruberu.redis_storage import RedisStorage
+from maruberu.resource_table import ResourceTable
+from maruberu.webhook import WebhookDispatcher
+
+
+class NoopBell(MaruBell):
+    """Bell implementation without ring command."""
+
+    async def execute(self, resource: BellResource) -> int:
+        """Return success immediately."""
+        await asyncio.sleep(0)
+        return 0
+
+
+def create_storage(name: str, redis_address: Optional[str],
+                   fake_shards: int=1) -> Optional[BaseStorage]:
+    """Create storage for benchmark (return None if it is not available)."""
+    if name == "ON_MEMORY":
+        return MemoryStorage(DataBaseAddress("localhost:6379/0"))
+    elif redis_address:
+        shards = DataBaseAddress.parse_list(redis_address)
+        storage = RedisStorage(shards[0], shards)
+        for x in storage.shards:
+            x.flushdb()
+        return storage
+    try:
+        import fakeredis
+    except ImportError:
+        logging.warning("Skip REDIS (specify --redis or install fakeredis).")
+        return None
+    shards = [DataBaseAddress("localhost:{}/0".format(6379 + x)) for x in range(fake_shards)]
+    storage = RedisStorage(shards[0], shards)
+    storage.shards = [fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()) for _ in shards]
+    return storage
+
+
+def summarize(latencies: List[float], codes: Counter, elapsed: float) -> Dict:
+    """Summarize latencies (in seconds) and status codes of a scenario."""
+    latencies = sorted(latencies)
+    total = len(latencies)
+    return {"requests": total,
+            "throughput": total / elapsed if elapsed else 0,
+            "p50": latencies[int(total * 0.50)] * 1000 if total else None,
+            "p99": latencies[min(total - 1, int(total * 0.99))] * 1000 if total else None,
+            "mean": statistics.mean(latencies) * 1000 if total else None,
+            "codes": {str(k): v / total for k, v in sorted(codes.items())}}
+
+
+async def drive(requests: List[httpclient.HTTPRequest], concurrency: int) -> Dict:
+    """Send requests with concurrent clients and summarize them."""
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies: List[float] = list()
+    codes: Counter = Counter()
+    pending = iter(requests)
+
+    async def worker() -> None:
+        for req in pending:
+            start = time.perf_counter()
+            res = await client.fetch(req, raise_error=False)
+            latencies.append(time.perf_counter() - start)
+            codes[res.code] += 1
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    client.close()
+    return summarize(latencies, codes, elapsed)
+
+
+async def run_backend(storage: BaseStorage, args: argparse.Namespace) -> Dict:
+    """Run all scenarios against storage."""
+    bell = NoopBell(storage)
+    env = {"bell": bell, "database": storage, "scheduler": BellScheduler(bell, storage),
+           "table": ResourceTable.attach(storage), "webhook": WebhookDispatcher.attach(bell)}
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(make_app(env))
+    server.add_sockets([sock])
+    base = "http://127.0.0.1:{}".format(port)
+
+    tokens = list()
+    for _ in range(args.tokens):
+        r = BellResource(1000, None, None, sticky=True, api=True)
+        await storage.create_resource(r)
+        tokens.append(r.uuid)
+    headers = {"Accept": "application/json"}
+    scenarios = {
+        "index": [httpclient.HTTPRequest(base + "/") for _ in range(args.requests)],
+        "get": [httpclient.HTTPRequest("{}/resource/{}/".format(base, tokens[x % len(tokens)]),
+                                       headers=headers)
+                for x in range(args.requests)],
+        "post": [httpclient.HTTPRequest("{}/resource/{}/".format(base, tokens[x % len(tokens)]),
+                                        method="POST", body="", headers=headers)
+                 for x in range(args.requests)],
+    }
+    results = dict()
+    for name, requests in scenarios.items():
+        results[name] = await drive(requests, args.concurrency)
+    server.stop()
+    await bell._ring_queue.put(None)
+    return results
+
+
+def compare(baseline: Dict, current: Dict) -> None:
+    """Print difference between baseline and current results."""
+    print("{:<10} {:<6} {:<11} {:>12} {:>12} {:>8}".format(
+        "env", "case", "metric", "baseline", "current", "diff"))
+    for env, cases in current["results"].items():
+        for case, result in cases.items():
+            base = baseline.get("results", {}).get(env, {}).get(case)
+            if not base:
+                continue
+            for metric in ("throughput", "p50", "p99"):
+                if base[metric] and result[metric]:
+                    diff = (result[metric] - base[metric]) / base[metric] * 100
+                    print("{:<10} {:<6} {:<11} {:>12.2f} {:>12.2f} {:>+7.1f}%".format(
+                        env, case, metric, base[metric], result[metric], diff))
+
+
+async def main(args: argparse.Namespace) -> Dict:
+    """Run benchmark for each backend."""
+    results = dict()
+    for name in args.env:
+        storage = create_storage(name, args.redis, args.fake_shards)
+        if storage is None:
+            continue
+        results[name] = await run_backend(storage, args)
+    return {"version": maruberu.__version__,
+            "date": datetime.now().isoformat(),
+            "params": {"requests": args.requests, "concurrency": args.concurrency,
+                       "tokens": args.tokens},
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--env", nargs="+", default=["ON_MEMORY", "REDIS"])
+    parser.add_argument("--redis", default=None,
+                        help="e.g. localhost:6379/15,localhost:6380/15 (will be flushed)")
+    parser.add_argument("--fake-shards", type=int, default=1,
+                        help="number of fakeredis shards (without --redis)")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--tokens", type=int, default=16)
+    parser.add_argument("--output", default=None, help="save results as json")
+    parser.add_argument("--compare", default=None, help="compare with saved results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.CRITICAL)
+
+    result = ioloop.IOLoop.current().run_sync(lambda: main(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Signal handling checks and reload benchmark of Server.
+
+Create Server in-process with ON_MEMORY backend and a conf file in a temporary
+directory, then check that reload applies the conf or keeps all options on error, and
+that handoff is refused when tokens on memory cannot be taken over. New processes of
+handoff are recorded instead of being started.
+
+    python -m benchmarks.bench_server --reloads 100
+    python -m benchmarks.bench_server --check-only
+"""
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from tornado import ioloop
+from tornado import testing
+from tornado.options import options
+
+import maruberu
+from maruberu import main as server_main
+from maruberu.infrastructure import BellScheduler, MaruBell, MemoryStorage
+from maruberu.models import DataBaseAddress
+from maruberu.resource_table import ResourceTable
+from maruberu.webhook import WebhookDispatcher
+
+
+class Recorder(object):
+    """Stand-in of subprocess.Popen which records arguments instead of starting process."""
+
+    def __init__(self) -> None:
+        """Initialize with no calls."""
+        self.calls: List[list] = list()
+
+    def __call__(self, args: list, **kwargs) -> "Recorder":
+        """Record arguments."""
+        self.calls.append(args)
+        self.pid = 0
+        return self
+
+
+def create_server(conf: str) -> server_main.Server:
+    """Load options from conf and create Server with ON_MEMORY backend."""
+    sys.argv = [sys.argv[0], "--conf={}".format(conf)]
+    server_main.load_options(final=False)
+    storage = MemoryStorage(DataBaseAddress("localhost:6379/0"))
+    bell = MaruBell(storage)
+    env = {"bell": bell, "database": storage, "scheduler": BellScheduler(bell, storage),
+           "table": ResourceTable.attach(storage), "webhook": WebhookDispatcher.attach(bell)}
+    sock, _ = testing.bind_unused_port()
+    return server_main.Server(server_main.make_app(env), env, [sock])
+
+
+def write_conf(path: str, body: str) -> None:
+    """Write conf file."""
+    with open(path, "w") as f:
+        f.write(body)
+
+
+async def check_reload(server: server_main.Server, conf: str) -> None:
+    """Reload applies conf and hashes the new admin password."""
+    write_conf(conf, 'admin_password="changed"\nexpiring_soon=3600\n')
+    server.reload()
+    assert options.expiring_soon == 3600
+    assert options.admin_password_hashed, "admin password is not hashed"
+    assert server_main.crypt.crypt("changed", options.admin_password_hashed) == \
+        options.admin_password_hashed, "admin password hash is not updated"
+
+
+async def check_reload_error(server: server_main.Server, conf: str) -> None:
+    """Reload keeps all options (including admin password hash) if conf is broken."""
+    write_conf(conf, 'admin_password="kept"\nexpiring_soon=60\n')
+    server.reload()
+    before = {k: v for k, v in options.items()}
+    for body in ('admin_password="broken"\nexpiring_soon=1\nring_timeout_grace=x y\n',
+                 'admin_password="broken"\nexpiring_soon=1\nring_timeout_grace="x"\n'):
+        write_conf(conf, body)
+        server.reload()
+        changed = sorted(k for k, v in options.items() if before[k] != v)
+        assert not changed, "options are changed by broken conf: {}".format(changed)
+
+
+async def check_handoff(server: server_main.Server, conf: str) -> None:
+    """Handoff is refused without memory_snapshot, and passes sockets with it."""
+    popen = server_main.subprocess.Popen
+    recorder = server_main.subprocess.Popen = Recorder()
+    try:
+        write_conf(conf, 'memory_snapshot=""\n')
+        server.reload()
+        server.handoff()
+        assert recorder.calls == [], "tokens on memory are dropped by handoff"
+        write_conf(conf, 'memory_snapshot="{}"\n'.format(conf + ".snapshot"))
+        server.reload()
+        server.handoff()
+        assert len(recorder.calls) == 1, "handoff is refused with memory_snapshot"
+        args = recorder.calls[0]
+        assert "--handoff_pid={}".format(os.getpid()) in args
+        assert "--listen_fds={}".format(server.sockets[0].fileno()) in args
+    finally:
+        server_main.subprocess.Popen = popen
+
+
+CHECKS = [check_reload, check_reload_error, check_handoff]
+
+
+async def check_signals(server: server_main.Server, conf: str) -> bool:
+    """Run all checks and print results."""
+    ok = True
+    for check in CHECKS:
+        try:
+            await check(server, conf)
+        except Exception as ex:
+            ok = False
+            print("FAIL Server {}: {!r}".format(check.__name__, ex))
+        else:
+            print("PASS Server {}".format(check.__name__))
+    return ok
+
+
+async def bench(server: server_main.Server, conf: str, args: argparse.Namespace) -> Dict:
+    """Measure time of reloading conf and templates."""
+    write_conf(conf, 'admin_password="bench"\n')
+    latencies = list()
+    for _ in range(args.reloads):
+        start = time.perf_counter()
+        server.reload()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {"reloads": len(latencies),
+            "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+            "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None}
+
+
+def main(args: argparse.Namespace) -> Dict:
+    """Run checks and benchmark."""
+    argv = sys.argv
+    with tempfile.TemporaryDirectory() as tmp:
+        conf = os.path.join(tmp, "server.conf")
+        write_conf(conf, "")
+        try:
+            server = create_server(conf)
+            ok = ioloop.IOLoop.current().run_sync(lambda: check_signals(server, conf))
+            result = None
+            if not args.check_only:
+                result = ioloop.IOLoop.current().run_sync(lambda: bench(server, conf, args))
+                print(json.dumps(result))
+        finally:
+            sys.argv = argv
+    return {"version": maruberu.__version__,
+            "date": datetime.now().isoformat(),
+            "conformance": ok,
+            "params": {"reloads": args.reloads},
+            "results": result}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--reloads", type=int, default=100)
+    parser.add_argument("--check-only", action="store_true")
+    parser.add_argument("--output", default=None, help="save results as json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    result = main(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if not result["conformance"]:
+        raise SystemExit(1)
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Deterministic simulation of ring pipeline with virtual clock.
+
+Run randomized concurrent clients against each storage and MaruBell whose ring command
+is replaced with fake driver, on the event loop whose clock jumps to the next timer
+instead of sleeping. Then check invariants of the resource state machine:
+
+* no double ring: bell rings one resource at a time, every accepted ring is executed
+  exactly once, and non-sticky resource succeeds at most once.
+* no ring out of period: accepted rings are within valid period of the resource.
+* no stuck USING: no resource is in use after the queue is drained.
+* sticky recovery: final status and failed count follow the last ring result.
+
+Tasks which wait forever without timer are reported as deadlock.
+
+    python -m benchmarks.bench_simulation --clients 2000 --seeds 1 2 3
+    python -m benchmarks.bench_simulation --env ON_MEMORY --fail-rate 0.3
+
+The same seed gives the same operations (and the same result).
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+import json
+import logging
+import random
+import selectors
+import sys
+import time
+import types
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+import pytz
+from tornado.options import options
+
+import maruberu.main
+from maruberu import infrastructure
+from maruberu import models
+from maruberu.infrastructure import MaruBell
+from maruberu.models import BaseStorage, BellResource, BellResourcePriority, BellResourceStatus
+from maruberu.models import VersionConflictError
+
+from .bench_storage import create_storage
+
+
+class DeadlockError(RuntimeError):
+    """All tasks are waiting for each other without timer."""
+
+
+class VirtualClock(object):
+    """Seconds from `EPOCH` which are advanced only by VirtualClockLoop."""
+
+    EPOCH = datetime(2030, 1, 1, tzinfo=pytz.utc)
+
+    def __init__(self) -> None:
+        """Initialize at `EPOCH`."""
+        self.now = 0.0
+
+    def datetime(self, tz: Optional[datetime.tzinfo]=None) -> datetime:
+        """Return current time as datetime (naive local time if tz is omitted)."""
+        d = self.EPOCH + timedelta(seconds=self.now)
+        return d.astimezone(tz) if tz else d.astimezone().replace(tzinfo=None)
+
+    def patch(self) -> List[Tuple[types.ModuleType, str, object]]:
+        """Replace clocks of maruberu modules with this clock (return original ones)."""
+        clock = self
+
+        class VirtualDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.datetime(tz)
+        virtual_time = types.SimpleNamespace(perf_counter=lambda: clock.now,
+                                             monotonic=lambda: clock.now)
+        patches = [(models, "datetime", VirtualDatetime),
+                   (infrastructure, "datetime", VirtualDatetime),
+                   (infrastructure, "time", virtual_time)]
+        originals = [(m, name, getattr(m, name)) for m, name, _ in patches]
+        for m, name, value in patches:
+            setattr(m, name, value)
+        return originals
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Selector which advances clock by timeout instead of waiting."""
+
+    def __init__(self, clock: VirtualClock) -> None:
+        """Initialize with clock."""
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout: Optional[float]=None):
+        """Poll events, and advance clock to the next timer if nothing is ready."""
+        events = super().select(0)
+        if not events:
+            if timeout is None:
+                raise DeadlockError("All tasks are waiting without timer.")
+            self._clock.now += timeout
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop on virtual clock."""
+
+    def __init__(self, clock: VirtualClock) -> None:
+        """Initialize with clock."""
+        super().__init__(VirtualSelector(clock))
+        self._clock = clock
+
+    def time(self) -> float:
+        """Return virtual time."""
+        return self._clock.now
+
+
+class FakeBell(MaruBell):
+    """Bell whose ring command takes its sequence in virtual time and fails randomly."""
+
+    def __init__(self, database: BaseStorage, rng: random.Random,
+                 fail_rate: float, hang_rate: float) -> None:
+        """Initialize with database, random generator and rates of failure and timeout."""
+        super().__init__(database)
+        self.rng = rng
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.rings: List[Tuple[str, float, float, bool]] = list()
+        self.overlaps = 0
+        self._ringing = False
+
+    async def execute(self, resource: BellResource) -> int:
+        """Sleep for the sequence, and return failure or time out at random."""
+        if self._ringing:
+            self.overlaps += 1
+        self._ringing = True
+        start = asyncio.get_running_loop().time()
+        ok = False
+        try:
+            duration = sum(resource.get_sequence()) / 1000
+            x = self.rng.random()
+            if x < self.hang_rate:
+                await asyncio.sleep(duration + options.ring_timeout_grace)
+                self._degrade("ベルが応答しません。")
+                raise asyncio.TimeoutError
+            await asyncio.sleep(duration)
+            ok = x >= self.hang_rate + self.fail_rate
+            return 0 if ok else 1
+        finally:
+            self._ringing = False
+            self.rings.append((resource.uuid, start, asyncio.get_running_loop().time(), ok))
+
+
+class Simulation(object):
+    """Clients, resources and records of one simulation run."""
+
+    def __init__(self, storage: BaseStorage, clock: VirtualClock,
+                 args: argparse.Namespace, seed: int) -> None:
+        """Initialize with storage, clock, parameters and random seed."""
+        self.storage = storage
+        self.clock = clock
+        self.args = args
+        self.rng = random.Random(seed)
+        self.bell = FakeBell(storage, random.Random(seed + 1), args.fail_rate, args.hang_rate)
+        self.resources: Dict[str, BellResource] = dict()
+        self.deleted: List[str] = list()
+        self.accepted: Counter = Counter()
+        self.results: Counter = Counter()
+        self.violations: List[str] = list()
+
+    def _time(self, offset: float) -> datetime:
+        return VirtualClock.EPOCH + timedelta(seconds=offset)
+
+    async def create_resources(self) -> None:
+        """Create resources with random flags, sequences and periods."""
+        horizon = self.args.spread * 2
+        for _ in range(self.args.tokens):
+            rng = self.rng
+            pattern = ([rng.randint(50, 500) for _ in range(rng.choice([3, 5]))]
+                       if rng.random() < 0.2 else None)
+            not_before = (self._time(rng.uniform(0, horizon / 4))
+                          if rng.random() < 0.3 else None)
+            not_after = (self._time(rng.uniform(horizon / 4, horizon))
+                         if rng.random() < 0.3 else None)
+            r = BellResource(rng.randint(100, 3000), not_before, not_after,
+                             sticky=rng.random() < 0.5, api=True, pattern=pattern,
+                             coalesce=rng.random() < 0.2,
+                             priority=rng.choice(list(BellResourcePriority)),
+                             uuid=str(uuid.UUID(int=rng.getrandbits(128))))
+            await self.storage.create_resource(r)
+            self.resources[r.uuid] = r
+
+    async def ring(self, token: str) -> None:
+        """Ring resource in the same way as ResourceHandler."""
+        attached = self.bell.attach(token)
+        if attached:
+            await attached[1]
+            self.results["coalesced"] += 1
+            return
+        resource = await self.storage.get_resource(token)
+        error = None
+        if resource:
+            resource, error = await self.storage.ring_resource(resource, self.bell)
+        if not resource:
+            self.results["missing"] += 1
+        elif error:
+            self.results[type(error).__name__] += 1
+        else:
+            self.results["accepted"] += 1
+            self.accepted[token] += 1
+            now = self.clock.datetime(pytz.utc)
+            if ((resource.not_before and now < resource.not_before) or
+                    (resource.not_after and resource.not_after < now)):
+                self.violations.append("'{}' was rung out of period at {}.".format(token, now))
+
+    async def edit(self, token: str) -> None:
+        """Change milliseconds of resource in context which is held for a while."""
+        c = await self.storage.get_resource_context(token)
+        try:
+            async with c:
+                if not c.resource:
+                    self.results["missing"] += 1
+                    return
+                await asyncio.sleep(self.rng.uniform(0, 0.5))
+                c.resource.milliseconds = self.rng.randint(100, 3000)
+        except VersionConflictError:
+            self.results["edit_conflict"] += 1
+        else:
+            self.results["edited"] += 1
+
+    async def delete(self, token: str) -> None:
+        """Delete resource."""
+        try:
+            await self.storage.delete_resource(token)
+        except KeyError:
+            self.results["missing"] += 1
+        else:
+            self.results["deleted"] += 1
+            self.deleted.append(token)
+
+    async def client(self) -> None:
+        """Run random operations with random think time."""
+        rng = self.rng
+        tokens = list(self.resources)
+        await asyncio.sleep(rng.uniform(0, self.args.spread))
+        for _ in range(self.args.operations):
+            token = rng.choice(tokens)
+            x = rng.random()
+            if x < 0.85:
+                await self.ring(token)
+            elif x < 0.95:
+                await self.storage.get_resource(token)
+                self.results["read"] += 1
+            elif x < 0.999:
+                await self.edit(token)
+            else:
+                await self.delete(token)
+            await asyncio.sleep(rng.expovariate(1 / self.args.think_time))
+
+    async def run(self) -> None:
+        """Run all clients and wait until the queue is drained."""
+        await self.create_resources()
+        await asyncio.gather(*[self.client() for _ in range(self.args.clients)])
+        await self.bell._ring_queue.join()
+        await self.bell._ring_queue.put(None)
+        await asyncio.sleep(0)
+
+    def _expected(self, resource: BellResource) -> Tuple[BellResourceStatus, int]:
+        """Return status and failed count which follow ring results of resource."""
+        results = [(end, ok) for token, _, end, ok in self.bell.rings if token == resource.uuid]
+        if not results:
+            return BellResourceStatus.UNUSED, 0
+        end, ok = results[-1]
+        now = self.clock.EPOCH + timedelta(seconds=end)
+        within = not ((resource.not_before and now < resource.not_before) or
+                      (resource.not_after and resource.not_after < now))
+        if ok:
+            unused = resource.sticky and within
+            return BellResourceStatus.UNUSED if unused else BellResourceStatus.USED, 0
+        failed = 0
+        for _, x in reversed(results):
+            if x:
+                break
+            failed += 1
+        return BellResourceStatus.UNUSED if within else BellResourceStatus.USED, failed
+
+    async def check(self) -> None:
+        """Check invariants after all clients finished."""
+        if self.bell.overlaps:
+            self.violations.append("Bell rang {} times during ringing.".format(self.bell.overlaps))
+        executed = Counter(x[0] for x in self.bell.rings)
+        succeeded = Counter(x[0] for x in self.bell.rings if x[3])
+        for token in self.resources:
+            if executed[token] != self.accepted[token]:
+                msg = "'{}' was accepted {} times but rung {} times."
+                self.violations.append(msg.format(token, self.accepted[token], executed[token]))
+            if not self.resources[token].sticky and succeeded[token] > 1:
+                msg = "Non-sticky '{}' succeeded {} times."
+                self.violations.append(msg.format(token, succeeded[token]))
+        for token in self.resources:
+            if token in self.deleted:
+                continue
+            resource = await self.storage.get_resource(token)
+            if resource is None:
+                self.violations.append("'{}' disappeared.".format(token))
+                continue
+            actual = (resource._status, resource._failed_count)
+            expected = self._expected(resource)
+            if resource.is_using():
+                self.violations.append("'{}' is stuck in USING.".format(token))
+            elif actual != expected:
+                msg = "'{}' is {} (failed {}) but expected {} (failed {})."
+                self.violations.append(msg.format(token, actual[0].name, actual[1],
+                                                  expected[0].name, expected[1]))
+
+    def summarize(self, elapsed: float) -> Dict:
+        """Summarize results and throughput."""
+        busy = sum(end - start for _, start, end, _ in self.bell.rings)
+        operations = self.args.clients * self.args.operations
+        return {"operations": operations,
+                "results": dict(sorted(self.results.items())),
+                "rings": len(self.bell.rings),
+                "succeeded": sum(1 for x in self.bell.rings if x[3]),
+                "virtual_seconds": self.clock.now,
+                "bell_utilization": busy / self.clock.now if self.clock.now else 0,
+                "real_seconds": elapsed,
+                "operations_per_second": operations / elapsed if elapsed else 0,
+                "violations": self.violations[:self.args.max_violations],
+                "violation_count": len(self.violations)}
+
+
+def run_simulation(name: str, seed: int, args: argparse.Namespace) -> Optional[Dict]:
+    """Run one simulation with storage on new virtual clock loop."""
+    clock = VirtualClock()
+    loop = VirtualClockLoop(clock)
+    asyncio.set_event_loop(loop)
+    originals = clock.patch()
+    try:
+        storage = create_storage(name, args.redis)
+        if storage is None:
+            return None
+        sim = Simulation(storage, clock, args, seed)
+        start = time.perf_counter()
+        try:
+            loop.run_until_complete(sim.run())
+            loop.run_until_complete(sim.check())
+        except DeadlockError as ex:
+            sim.violations.append(str(ex))
+        return sim.summarize(time.perf_counter() - start)
+    finally:
+        for m, attr, value in originals:
+            setattr(m, attr, value)
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def main(args: argparse.Namespace) -> Dict:
+    """Run simulations for each backend and seed."""
+    options.ring_degraded_cooldown = args.cooldown
+    results: Dict[str, Dict] = dict()
+    for name in args.env:
+        for seed in args.seeds:
+            result = run_simulation(name, seed, args)
+            if result is not None:
+                results.setdefault(name, dict())[str(seed)] = result
+    return {"version": maruberu.__version__,
+            "date": datetime.now().isoformat(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("env", "redis")},
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--env", nargs="+", default=["ON_MEMORY", "ON_MEMORY_SPILL", "REDIS"])
+    parser.add_argument("--redis", default=None,
+                        help="e.g. localhost:6379/15 (will be flushed)")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[1])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--operations", type=int, default=20, help="per client")
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--spread", type=float, default=600.0,
+                        help="seconds over which clients start")
+    parser.add_argument("--think-time", type=float, default=5.0,
+                        help="mean seconds between operations of client")
+    parser.add_argument("--fail-rate", type=float, default=0.1)
+    parser.add_argument("--hang-rate", type=float, default=0.002)
+    parser.add_argument("--cooldown", type=float, default=10.0,
+                        help="ring_degraded_cooldown in virtual seconds")
+    parser.add_argument("--max-violations", type=int, default=20)
+    parser.add_argument("--output", default=None, help="save results as json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    result = main(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if any(x["violation_count"] for y in result["results"].values() for x in y.values()):
+        sys.exit(1)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Conformance checks and scaling benchmark of BaseStorage implementations.
+
+Check that every backend follows `BaseStorage` semantics, then measure create,
+contended get-context, snapshot read, list-page and delete at each size.
+
+    python -m benchmarks.bench_storage --sizes 1000 100000 --concurrency 16
+    python -m benchmarks.bench_storage --check-only
+
+REDIS backend uses `--redis` address if specified, or `fakeredis` as in-process stand-in.
+ON_MEMORY_SPILL backend is MemoryStorage which keeps `--memory-cap` resources on memory
+(2 in checks), and its benchmark also measures latency of reading resources on memory
+(hit) and in spill file (miss).
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import json
+import logging
+import random
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+import pytz
+from tornado import ioloop
+from tornado.options import options
+
+import maruberu
+import maruberu.main
+from maruberu import infrastructure
+from maruberu.infrastructure import MemoryStorage
+from maruberu.models import BaseStorage, BellResource, BellResourceStatus, DataBaseAddress
+from maruberu.models import RingEvent, RingSchedule, VersionConflictError
+from maruberu.redis_storage import RedisStorage
+from maruberu.token_filter import CountingBloomFilter
+
+
+def create_storage(name: str, redis_address: Optional[str],
+                   fake_shards: int=1, memory_cap: int=2) -> Optional[BaseStorage]:
+    """Create empty storage (return None if it is not available)."""
+    if name in ("ON_MEMORY", "ON_MEMORY_SPILL"):
+        infrastructure.memory_storage_resource.clear()
+        infrastructure.memory_storage_lock.clear()
+        infrastructure.memory_storage_spilled.clear()
+        infrastructure.memory_storage_schedule.clear()
+        infrastructure.memory_storage_index.clear()
+        infrastructure.memory_storage_event.clear()
+        infrastructure.memory_storage_event_index.clear()
+        return MemoryStorage(DataBaseAddress("localhost:6379/0"),
+                             max_resources=memory_cap if name == "ON_MEMORY_SPILL" else 0)
+    elif redis_address:
+        shards = DataBaseAddress.parse_list(redis_address)
+        storage = RedisStorage(shards[0], shards)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            logging.warning("Skip REDIS (specify --redis or install fakeredis).")
+            return None
+        shards = [DataBaseAddress("localhost:{}/0".format(6379 + x)) for x in range(fake_shards)]
+        storage = RedisStorage(shards[0], shards)
+        storage.shards = [fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+                          for _ in shards]
+    for x in storage.shards:
+        x.flushdb()
+    return storage
+
+
+def new_resource(created_at: Optional[datetime]=None, **kwargs) -> BellResource:
+    """Create resource for checks and benchmark."""
+    return BellResource(1000, None, None,
+                        created_at=created_at.isoformat() if created_at else None, **kwargs)
+
+
+async def check_create_and_get(storage: BaseStorage) -> None:
+    """Created resource can be read as it was, and uuid must be unique."""
+    tz = pytz.timezone("Asia/Tokyo")
+    r = new_resource(sticky=True, api=True)
+    r.not_before = tz.localize(datetime(2000, 1, 1))
+    r.not_after = tz.localize(datetime(9999, 1, 1))
+    await storage.create_resource(r)
+    assert (await storage.get_resource(r.uuid)).to_dict() == r.to_dict()
+    c = await storage.get_resource_context(r.uuid)
+    async with c:
+        assert c.resource.to_dict() == r.to_dict()
+    try:
+        await storage.create_resource(r)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("duplicated uuid is accepted")
+
+
+async def check_missing(storage: BaseStorage) -> None:
+    """Unknown key returns no resource and cannot be deleted."""
+    key = new_resource().uuid
+    assert await storage.get_resource(key) is None
+    c = await storage.get_resource_context(key)
+    async with c:
+        assert c.resource is None
+    try:
+        await storage.delete_resource(key)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("unknown resource is deleted")
+
+
+async def check_write_back(storage: BaseStorage) -> None:
+    """Context writes back resource on success and discards it on exception."""
+    r = new_resource()
+    await storage.create_resource(r)
+    c = await storage.get_resource_context(r.uuid)
+    async with c:
+        c.resource._status = BellResourceStatus.USED
+    assert (await storage.get_resource(r.uuid)).is_used()
+    try:
+        c = await storage.get_resource_context(r.uuid)
+        async with c:
+            c.resource._status = BellResourceStatus.UNUSED
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert (await storage.get_resource(r.uuid)).is_used()
+    c = await storage.get_resource_context(r.uuid)
+    async with c:
+        assert c.resource.is_used()
+
+
+async def check_update(storage: BaseStorage) -> None:
+    """Update succeeds only with the current version, and context write-back also checks it."""
+    r = new_resource()
+    await storage.create_resource(r)
+    stale = await storage.get_resource(r.uuid)
+    r._status = BellResourceStatus.USING
+    await storage.update_resource(r)
+    assert r.version == 1 and (await storage.get_resource(r.uuid)).version == 1
+    try:
+        await storage.update_resource(stale)
+    except VersionConflictError as ex:
+        assert ex.resource.version == 1 and ex.resource.is_using()
+    else:
+        raise AssertionError("stale update was accepted")
+    c = await storage.get_resource_context(r.uuid)
+    try:
+        async with c:
+            c.resource._status = BellResourceStatus.USED
+            await storage.update_resource(await storage.get_resource(r.uuid))
+    except VersionConflictError:
+        pass
+    else:
+        raise AssertionError("stale write-back was accepted")
+    assert (await storage.get_resource(r.uuid)).version == 2
+    await storage.delete_resource(r.uuid)
+    try:
+        await storage.update_resource(r)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("deleted resource was updated")
+
+
+async def check_delete(storage: BaseStorage) -> None:
+    """Deleted resource is returned and disappears from database and list."""
+    r = new_resource()
+    await storage.create_resource(r)
+    assert (await storage.delete_resource(r.uuid)).uuid == r.uuid
+    assert await storage.get_resource(r.uuid) is None
+    assert r.uuid not in [x.uuid for x in storage.get_all_resources()]
+
+
+async def check_list(storage: BaseStorage) -> None:
+    """List is ordered from newest, and pages with start_key and limit cover it."""
+    base = datetime.now(pytz.utc) - timedelta(days=1)
+    for x in range(7):
+        await storage.create_resource(new_resource(base + timedelta(seconds=x % 5)))
+    items = storage.get_all_resources()
+    keys = [(x.created_at, x.uuid) for x in items]
+    assert keys == sorted(keys, reverse=True), "list is not ordered from newest"
+    assert [x.uuid for x in storage.get_all_resources(limit=3)] == [x.uuid for x in items[:3]]
+    pages, start = list(), None
+    while True:
+        page = storage.get_all_resources(start_key=start, limit=4)
+        pages.extend(page if start is None else page[1:])
+        if len(page) < 4:
+            break
+        start = page[-1].uuid
+    assert [x.uuid for x in pages] == [x.uuid for x in items], "pages do not cover list"
+    try:
+        storage.get_all_resources(start_key=new_resource().uuid)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("unknown start_key is accepted")
+    keys = [items[3].uuid, new_resource().uuid, items[0].uuid]
+    assert [x.uuid for x in storage.get_resources(keys)] == [keys[0], keys[2]]
+
+
+async def check_schedule(storage: BaseStorage) -> None:
+    """Schedules are ordered by fire time and can be deleted once."""
+    now = datetime.now(pytz.utc)
+    later = RingSchedule(new_resource().uuid, now + timedelta(hours=2))
+    sooner = RingSchedule(new_resource().uuid, now + timedelta(hours=1))
+    await storage.create_schedule(later)
+    await storage.create_schedule(sooner)
+    keys = [x.uuid for x in storage.get_all_schedules()]
+    assert keys.index(sooner.uuid) < keys.index(later.uuid)
+    assert (await storage.delete_schedule(later.uuid)).to_dict() == later.to_dict()
+    try:
+        await storage.delete_schedule(later.uuid)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("deleted schedule is deleted again")
+
+
+async def check_events(storage: BaseStorage) -> None:
+    """Events are returned from newest and filtered by token, time range and limit."""
+    now = datetime.now(pytz.utc)
+    a, b = new_resource().uuid, new_resource().uuid
+    for token in (a, b, a):
+        await storage.append_event(RingEvent(token, now, now, datetime.now(pytz.utc),
+                                             "success", 0))
+    events = storage.get_events(a)
+    assert [x.token for x in events] == [a, a]
+    assert events[0].finished_at >= events[1].finished_at, "events are not ordered from newest"
+    assert [x.token for x in storage.get_events(limit=2)] == [a, b]
+    assert storage.get_events(b, since=now + timedelta(hours=1)) == []
+    assert len(storage.get_events(b, since=now - timedelta(seconds=1),
+                                  until=now + timedelta(hours=1))) == 1
+
+
+async def check_idempotency(storage: BaseStorage) -> None:
+    """Reserved key is in flight until its response is stored, released or expired."""
+    key, released, crashed = (new_resource().uuid for _ in range(3))
+    assert await storage.reserve_response(key, 1) is None
+    assert await storage.reserve_response(key, 1) == {}, "in-flight key is reserved again"
+    response = {"code": 202, "content_type": "application/json", "body": "{}"}
+    await storage.store_response(key, response, 60)
+    assert await storage.reserve_response(released, 60) is None
+    await storage.release_response(released)
+    assert await storage.reserve_response(released, 60) is None, "released key is in flight"
+    assert await storage.reserve_response(crashed, 1) is None
+    await asyncio.sleep(1.1)
+    assert await storage.reserve_response(crashed, 60) is None, "reservation did not expire"
+    assert await storage.reserve_response(key, 60) == response, "response is not replayed"
+
+
+CHECKS = [check_create_and_get, check_missing, check_write_back, check_update, check_delete,
+          check_list, check_schedule, check_events, check_idempotency]
+
+
+async def check_filter_add_remove(storage: RedisStorage) -> None:
+    """Filter has no false negative, and removed keys are forgotten (unless saturated)."""
+    f = CountingBloomFilter(1000, options.token_filter_error_rate)
+    keys = [new_resource().uuid for _ in range(1000)]
+    for x in keys:
+        f.add(x)
+    assert all(x in f for x in keys), "added key is not found"
+    for x in keys[:500]:
+        f.remove(x)
+    assert all(x in f for x in keys[500:]), "key is lost by removing others"
+    assert sum(x in f for x in keys[:500]) <= 5, "removed keys are still found"
+    for _ in range(CountingBloomFilter.MAX_COUNT + 1):
+        f.add(keys[0])
+    f.remove(keys[0])
+    assert keys[0] in f, "saturated counter is decremented"
+
+
+async def check_filter_error_rate(storage: RedisStorage) -> None:
+    """False positive rate at capacity is close to `token_filter_error_rate`."""
+    rate = options.token_filter_error_rate
+    f = CountingBloomFilter.from_keys((new_resource().uuid for _ in range(10000)), 10000, rate)
+    samples = max(100000, int(100 / rate))
+    found = sum(new_resource().uuid in f for _ in range(samples))
+    assert found / samples <= rate * 1.5, "false positive rate {:.5f} > {} * 1.5".format(
+        found / samples, rate)
+
+
+async def check_filter_sync(storage: RedisStorage) -> None:
+    """Filter follows tokens of other processes by sync (created) and rebuild (deleted)."""
+    other = RedisStorage(storage.shard_addrs[0], storage.shard_addrs, filter_capacity=1000,
+                         filter_sync_interval=0)
+    other.shards = storage.shards
+    other.rebuild_filter()
+    local = RedisStorage(storage.shard_addrs[0], storage.shard_addrs, filter_capacity=1000,
+                         filter_sync_interval=0)
+    local.shards = storage.shards
+    kept, deleted = new_resource(), new_resource()
+    await other.create_resource(kept)
+    await other.create_resource(deleted)
+    local.rebuild_filter()
+    created = new_resource()
+    await other.create_resource(created)
+    assert await local.get_resource(created.uuid) is None, "filter is not used"
+    local.sync_filter()
+    local.sync_filter()
+    assert (await local.get_resource(created.uuid)).uuid == created.uuid, "sync missed token"
+    await local.delete_resource(created.uuid)
+    assert created.uuid not in local._filter, "token added twice by sync is not removed"
+    await other.delete_resource(deleted.uuid)
+    assert deleted.uuid in local._filter
+    local.rebuild_filter()
+    assert deleted.uuid not in local._filter, "rebuild kept deleted token"
+    assert (await local.get_resource(kept.uuid)).uuid == kept.uuid
+
+
+FILTER_CHECKS = [check_filter_add_remove, check_filter_error_rate, check_filter_sync]
+
+
+async def check_conformance(storage: BaseStorage) -> bool:
+    """Run all checks and print results."""
+    ok = True
+    for check in CHECKS + (FILTER_CHECKS if isinstance(storage, RedisStorage) else []):
+        try:
+            await check(storage)
+        except Exception as ex:
+            ok = False
+            print("FAIL {} {}: {!r}".format(type(storage).__name__, check.__name__, ex))
+        else:
+            print("PASS {} {}".format(type(storage).__name__, check.__name__))
+    return ok
+
+
+async def run_ops(op: Callable[..., Awaitable], args: Iterable, concurrency: int) -> Dict:
+    """Run `op(arg)` for all args with concurrent workers and return ops/sec."""
+    pending = iter(args)
+    count = 0
+
+    async def worker() -> None:
+        nonlocal count
+        for x in pending:
+            await op(x)
+            count += 1
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {"ops": count, "ops_per_sec": count / elapsed if elapsed else 0}
+
+
+def memory_per_resource(name: str, redis_address: Optional[str], fake_shards: int,
+                        count: int, memory_cap: int) -> Optional[float]:
+    """Measure bytes per resource by creating `count` resources in empty storage."""
+    storage = create_storage(name, redis_address, fake_shards, memory_cap)
+
+    async def create() -> None:
+        for _ in range(count):
+            await storage.create_resource(new_resource())
+    if isinstance(storage, RedisStorage):
+        try:
+            before = sum(x.info("memory")["used_memory"] for x in storage.shards)
+            ioloop.IOLoop.current().run_sync(create)
+            after = sum(x.info("memory")["used_memory"] for x in storage.shards)
+            return (after - before) / count
+        except Exception:
+            return None
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ioloop.IOLoop.current().run_sync(create)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+
+async def bench(storage: BaseStorage, size: int, args: argparse.Namespace) -> Dict:
+    """Run scaling benchmark at size."""
+    resources = [new_resource() for _ in range(size)]
+    keys = [x.uuid for x in resources]
+    hot = keys[:args.hot_keys]
+    result = {"create": await run_ops(storage.create_resource, resources, args.concurrency)}
+
+    async def get_context(key: str) -> None:
+        c = await storage.get_resource_context(key)
+        async with c:
+            c.resource.clear_validation_cache()
+    result["get_context"] = await run_ops(
+        get_context, (random.choice(hot) for _ in range(args.operations)), args.concurrency)
+    result["snapshot_read"] = await run_ops(
+        storage.get_resource, (random.choice(keys) for _ in range(args.operations)),
+        args.concurrency)
+
+    async def list_page(key: str) -> None:
+        storage.get_all_resources(start_key=key, limit=args.page_size)
+    result["list_page"] = await run_ops(
+        list_page, (random.choice(keys) for _ in range(max(1, args.operations // 10))),
+        args.concurrency)
+    result["delete"] = await run_ops(
+        storage.delete_resource, random.sample(keys, min(size, args.operations)),
+        args.concurrency)
+    return result
+
+
+async def latency(f: Callable[[str], Awaitable], keys: Iterable[str]) -> Dict:
+    """Call f with each key one by one and summarize latencies in microseconds."""
+    latencies = list()
+    for key in keys:
+        start = time.perf_counter()
+        await f(key)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {"ops": len(latencies),
+            "p50_us": latencies[len(latencies) // 2] * 1e6 if latencies else None,
+            "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6 if latencies else None}
+
+
+async def bench_paging(storage: MemoryStorage, size: int, args: argparse.Namespace) -> Dict:
+    """Measure reads of resources on memory (hit) and in spill file (miss)."""
+    for _ in range(size):
+        await storage.create_resource(new_resource())
+    resident = list(infrastructure.memory_storage_resource)[-max(1, args.memory_cap // 2):]
+    spilled = list(infrastructure.memory_storage_spilled)
+    result = {"resident": len(infrastructure.memory_storage_resource),
+              "spilled": len(spilled),
+              "hit": await latency(storage.get_resource,
+                                   (random.choice(resident) for _ in range(args.operations)))}
+    if spilled:
+        result["miss"] = await latency(
+            storage.get_resource, random.sample(spilled, min(len(spilled), args.operations)))
+    return result
+
+
+def main(args: argparse.Namespace) -> Dict:
+    """Run checks and benchmark for each backend."""
+    results = dict()
+    ok = True
+    for name in args.env:
+        storage = create_storage(name, args.redis, args.fake_shards)
+        if storage is None:
+            continue
+        ok = ioloop.IOLoop.current().run_sync(lambda: check_conformance(storage)) and ok
+        if args.check_only:
+            continue
+        results[name] = dict()
+        for size in args.sizes:
+            storage = create_storage(name, args.redis, args.fake_shards, args.memory_cap)
+            result = ioloop.IOLoop.current().run_sync(lambda: bench(storage, size, args))
+            result["bytes_per_resource"] = memory_per_resource(
+                name, args.redis, args.fake_shards, min(size, args.memory_sample),
+                args.memory_cap)
+            if name == "ON_MEMORY_SPILL":
+                storage = create_storage(name, args.redis, args.fake_shards, args.memory_cap)
+                result["paging"] = ioloop.IOLoop.current().run_sync(
+                    lambda: bench_paging(storage, size, args))
+            results[name][str(size)] = result
+            print(name, size, json.dumps(result))
+    return {"version": maruberu.__version__,
+            "date": datetime.now().isoformat(),
+            "conformance": ok,
+            "params": {"sizes": args.sizes, "concurrency": args.concurrency,
+                       "operations": args.operations, "hot_keys": args.hot_keys,
+                       "page_size": args.page_size, "memory_cap": args.memory_cap},
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--env", nargs="+", default=["ON_MEMORY", "ON_MEMORY_SPILL", "REDIS"])
+    parser.add_argument("--redis", default=None,
+                        help="e.g. localhost:6379/15,localhost:6380/15 (will be flushed)")
+    parser.add_argument("--fake-shards", type=int, default=1,
+                        help="number of fakeredis shards (without --redis)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 100000, 1000000])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=10000)
+    parser.add_argument("--hot-keys", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--memory-sample", type=int, default=10000)
+    parser.add_argument("--memory-cap", type=int, default=1000,
+                        help="resources on memory of ON_MEMORY_SPILL")
+    parser.add_argument("--check-only", action="store_true")
+    parser.add_argument("--output", default=None, help="save results as json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    result = main(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if not result["conformance"]:
+        raise SystemExit(1)
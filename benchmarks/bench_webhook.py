@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Delivery checks and throughput benchmark of WebhookDispatcher.
+
+Start a local receiver which records posted batches (and fails as requested), then
+check batching, retries with backoff, giving up on 4xx, dead letters and queue
+overflow, and measure events/sec delivered to the receiver.
+
+    python -m benchmarks.bench_webhook --events 10000 --batch-size 50
+    python -m benchmarks.bench_webhook --check-only
+"""
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import pytz
+from tornado import httpserver
+from tornado import ioloop
+from tornado import testing
+from tornado import web
+
+import maruberu
+from maruberu import metrics
+from maruberu.models import RingEvent
+from maruberu.webhook import WebhookDispatcher
+
+
+class Receiver(object):
+    """Local webhook endpoint which records batches by path.
+
+    `/ok/<name>` always succeeds, `/fail/<code>/<count>/<name>` answers `code` to the
+    first `count` requests (forever if `count` is 0) and succeeds after that.
+    """
+
+    def __init__(self) -> None:
+        """Initialize with no requests and start listening on unused port."""
+        self.requests: Dict[str, List[dict]] = dict()
+        receiver = self
+
+        class Handler(web.RequestHandler):
+            def post(self, *_) -> None:
+                tried = receiver.requests.setdefault(self.request.path, list())
+                tried.append({"time": time.perf_counter(),
+                              "events": json.loads(self.request.body)["events"]})
+                parts = self.request.path.split("/")
+                if parts[1] == "fail" and (parts[3] == "0" or len(tried) <= int(parts[3])):
+                    self.set_status(int(parts[2]))
+
+        sock, port = testing.bind_unused_port()
+        self.server = httpserver.HTTPServer(web.Application([(r"/.*", Handler)]))
+        self.server.add_sockets([sock])
+        self.base = "http://127.0.0.1:{}".format(port)
+
+    def url(self, path: str) -> str:
+        """Return URL of path."""
+        return self.base + path
+
+    def batches(self, path: str) -> List[List[dict]]:
+        """Return batches posted to path."""
+        return [x["events"] for x in self.requests.get(path, ())]
+
+    def close(self) -> None:
+        """Stop listening."""
+        self.server.stop()
+
+
+def new_event(n: int) -> RingEvent:
+    """Create ring event for checks and benchmark."""
+    now = datetime.now(pytz.utc)
+    return RingEvent("token-{}".format(n), now, now, now, "success", 0)
+
+
+def read_dead_letter(path: str) -> List[dict]:
+    """Read dead letter file (empty if it does not exist)."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(x) for x in f]
+
+
+def counts() -> Dict[str, float]:
+    """Return webhook event counters by result."""
+    return {x: metrics.WEBHOOK_EVENTS_TOTAL.labels(x).value
+            for x in ("delivered", "failed", "retried", "dropped")}
+
+
+def delta(before: Dict[str, float]) -> Dict[str, float]:
+    """Return increase of webhook event counters since `before`."""
+    return {k: v - before[k] for k, v in counts().items()}
+
+
+async def check_batching(receiver: Receiver, dead_letter: str) -> None:
+    """Events are posted to every URL in batches of batch_size at most."""
+    paths = ["/ok/batch-a", "/ok/batch-b"]
+    d = WebhookDispatcher([receiver.url(x) for x in paths], batch_size=5, batch_interval=0.2,
+                          dead_letter=dead_letter)
+    before = counts()
+    for x in range(12):
+        d.put(new_event(x))
+    await d.close(5.0)
+    for path in paths:
+        batches = receiver.batches(path)
+        assert all(0 < len(x) <= 5 for x in batches), "batch is too large"
+        assert len(batches) <= 6, "events are not batched"
+        assert sorted(y["token"] for x in batches for y in x) == sorted(
+            "token-{}".format(x) for x in range(12)), "events are lost or duplicated"
+    assert delta(before)["delivered"] == 24
+    assert read_dead_letter(dead_letter) == []
+
+
+async def check_batch_interval(receiver: Receiver, dead_letter: str) -> None:
+    """Partial batch is posted after batch_interval."""
+    path = "/ok/interval"
+    d = WebhookDispatcher([receiver.url(path)], batch_size=100, batch_interval=0.3,
+                          dead_letter=dead_letter)
+    start = time.perf_counter()
+    for x in range(3):
+        d.put(new_event(x))
+    await d.close(5.0)
+    assert [len(x) for x in receiver.batches(path)] == [3]
+    assert receiver.requests[path][0]["time"] - start >= 0.3, "batch is posted too early"
+
+
+async def check_retry(receiver: Receiver, dead_letter: str) -> None:
+    """Failed batch is retried with exponential backoff until it succeeds."""
+    path = "/fail/500/2/retry"
+    d = WebhookDispatcher([receiver.url(path)], batch_size=2, batch_interval=0.05,
+                          max_retries=5, retry_delay=0.1, dead_letter=dead_letter)
+    before = counts()
+    d.put(new_event(0))
+    d.put(new_event(1))
+    await d.close(5.0)
+    tried = receiver.requests[path]
+    assert len(tried) == 3, "batch was tried {} times".format(len(tried))
+    assert all(x["events"] == tried[0]["events"] for x in tried), "retried batch differs"
+    first, second = (tried[1]["time"] - tried[0]["time"], tried[2]["time"] - tried[1]["time"])
+    assert first >= 0.05 and second >= 0.1, "backoff is too short ({:.3f}, {:.3f})".format(
+        first, second)
+    assert delta(before) == {"delivered": 2, "failed": 0, "retried": 4, "dropped": 0}
+    assert read_dead_letter(dead_letter) == []
+
+
+async def check_retry_exhausted(receiver: Receiver, dead_letter: str) -> None:
+    """Batch is written to dead letter after max_retries retries."""
+    path = "/fail/503/0/exhausted"
+    d = WebhookDispatcher([receiver.url(path)], batch_interval=0.05, max_retries=2,
+                          retry_delay=0.01, dead_letter=dead_letter)
+    before = counts()
+    d.put(new_event(0))
+    await d.close(5.0)
+    assert len(receiver.requests[path]) == 3
+    assert delta(before) == {"delivered": 0, "failed": 1, "retried": 2, "dropped": 0}
+    letters = read_dead_letter(dead_letter)
+    assert [(x["url"], x["error"]) for x in letters] == [(receiver.url(path), "HTTP 503")]
+    assert letters[0]["events"] == receiver.batches(path)[0]
+
+
+async def check_give_up(receiver: Receiver, dead_letter: str) -> None:
+    """Batch is not retried on 4xx except 408 and 429."""
+    gone, busy = "/fail/404/0/gone", "/fail/429/1/busy"
+    d = WebhookDispatcher([receiver.url(gone), receiver.url(busy)], batch_interval=0.05,
+                          max_retries=3, retry_delay=0.01, dead_letter=dead_letter)
+    before = counts()
+    d.put(new_event(0))
+    await d.close(5.0)
+    assert len(receiver.requests[gone]) == 1, "4xx is retried"
+    assert len(receiver.requests[busy]) == 2, "429 is not retried"
+    assert delta(before) == {"delivered": 1, "failed": 1, "retried": 1, "dropped": 0}
+    assert [(x["url"], x["error"]) for x in read_dead_letter(dead_letter)] == [
+        (receiver.url(gone), "HTTP 404")]
+
+
+async def check_overflow(receiver: Receiver, dead_letter: str) -> None:
+    """Events which overflow the queue are dropped to dead letter at once."""
+    path = "/ok/overflow"
+    d = WebhookDispatcher([receiver.url(path)], queue_size=3, batch_interval=0.05,
+                          dead_letter=dead_letter)
+    before = counts()
+    for x in range(5):
+        d.put(new_event(x))
+    await d.close(5.0)
+    assert [y["token"] for x in receiver.batches(path) for y in x] == [
+        "token-{}".format(x) for x in range(3)]
+    assert delta(before) == {"delivered": 3, "failed": 0, "retried": 0, "dropped": 2}
+    letters = read_dead_letter(dead_letter)
+    assert [(x["error"], [y["token"] for y in x["events"]]) for x in letters] == [
+        ("queue is full", ["token-3"]), ("queue is full", ["token-4"])]
+
+
+CHECKS = [check_batching, check_batch_interval, check_retry, check_retry_exhausted,
+          check_give_up, check_overflow]
+
+
+async def check_delivery(receiver: Receiver) -> bool:
+    """Run all checks with new dead letter file and print results."""
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for check in CHECKS:
+            try:
+                await check(receiver, os.path.join(tmp, check.__name__ + ".jsonl"))
+            except Exception as ex:
+                ok = False
+                print("FAIL WebhookDispatcher {}: {!r}".format(check.__name__, ex))
+            else:
+                print("PASS WebhookDispatcher {}".format(check.__name__))
+    return ok
+
+
+async def bench(receiver: Receiver, args: argparse.Namespace) -> Dict:
+    """Measure events/sec delivered to the receiver."""
+    path = "/ok/bench-{}".format(args.batch_size)
+    d = WebhookDispatcher([receiver.url(path)], queue_size=args.events,
+                          batch_size=args.batch_size, batch_interval=args.batch_interval,
+                          max_clients=args.max_clients)
+    start = time.perf_counter()
+    for x in range(args.events):
+        d.put(new_event(x))
+    await d.close(600.0)
+    elapsed = time.perf_counter() - start
+    delivered = sum(len(x) for x in receiver.batches(path))
+    return {"events": delivered, "requests": len(receiver.requests.get(path, ())),
+            "events_per_sec": delivered / elapsed if elapsed else None}
+
+
+def main(args: argparse.Namespace) -> Dict:
+    """Run checks and benchmark."""
+    receiver = Receiver()
+    try:
+        ok = ioloop.IOLoop.current().run_sync(lambda: check_delivery(receiver))
+        result: Optional[Dict] = None
+        if not args.check_only:
+            result = ioloop.IOLoop.current().run_sync(lambda: bench(receiver, args))
+            print(json.dumps(result))
+    finally:
+        receiver.close()
+    return {"version": maruberu.__version__,
+            "date": datetime.now().isoformat(),
+            "conformance": ok,
+            "params": {"events": args.events, "batch_size": args.batch_size,
+                       "batch_interval": args.batch_interval, "max_clients": args.max_clients},
+            "results": result}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--batch-interval", type=float, default=0.1)
+    parser.add_argument("--max-clients", type=int, default=10)
+    parser.add_argument("--check-only", action="store_true")
+    parser.add_argument("--output", default=None, help="save results as json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    result = main(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if not result["conformance"]:
+        raise SystemExit(1)
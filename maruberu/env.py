@@ -1,31 +1,84 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""Environment module of maruberu."""
+"""Environment module of maruberu.
 
+Storage backends are registered by env name as `module:attribute`, and only the selected
+one is imported. Third-party backends can be registered as setuptools entry points in
+`maruberu.storage` group (e.g. `MY_ENV = my_package.storage:MyStorage`).
+"""
+
+import importlib
 import logging
+from typing import Callable, Dict, Optional
 
 from tornado import ioloop
 from tornado.options import options
 
-from .infrastructure import MaruBell, MemoryStorage, RedisStorage
+from .infrastructure import BellScheduler, MaruBell
 from .models import BaseBell, BaseStorage, DataBaseAddress, init_storage_with_sample_data
+from .resource_table import ResourceTable
+from .webhook import WebhookDispatcher
+
 
+ENTRY_POINT_GROUP = "maruberu.storage"
 
 _environment = None
+_backends: Dict[str, str] = {
+    "ON_MEMORY": "maruberu.infrastructure:MemoryStorage",
+    "REDIS": "maruberu.redis_storage:RedisStorage",
+}
+
+
+def register_backend(name: str, target: str) -> None:
+    """Register storage backend in `module:attribute` format with env name."""
+    _backends[name] = target
+
+
+def _find_entry_point(name: str) -> Optional[Callable]:
+    try:
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        group = (eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, "select")
+                 else eps.get(ENTRY_POINT_GROUP, []))
+    except ImportError:
+        import pkg_resources
+        group = pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+    for ep in group:
+        if ep.name == name:
+            return ep.load()
+    return None
+
+
+def load_backend(name: str) -> Optional[Callable]:
+    """Import storage backend class of env name (return None if it is not found)."""
+    target = _backends.get(name)
+    if target is None:
+        return _find_entry_point(name)
+    module, attr = target.split(":", 1)
+    return getattr(importlib.import_module(module), attr)
+
+
+def is_shared_env(name: str) -> bool:
+    """Check if storage of env name can be used by other processes at the same time."""
+    backend = load_backend(name) or load_backend("ON_MEMORY")
+    return getattr(backend, "SHARED", False)
 
 
 def _create_env(bell: BaseBell, database: BaseStorage) -> dict:
-    return {"bell": bell, "database": database}
+    return {"bell": bell,
+            "database": database,
+            "scheduler": BellScheduler(bell, database),
+            "table": ResourceTable.attach(database, options.resource_table_rebuild_interval),
+            "webhook": WebhookDispatcher.attach(bell)}
 
 
 def _load_env(name: str) -> dict:
-    db = DataBaseAddress(options.database)
-    if name == "REDIS":
-        storage = RedisStorage(db)
-    else:
-        storage = MemoryStorage(db)
-        if name != "ON_MEMORY":
-            logging.warning("env '{}' is not found (ON_MEMORY will be used).".format(name))
+    db = DataBaseAddress.parse_list(options.database)[0]
+    backend = load_backend(name)
+    if backend is None:
+        logging.warning("env '{}' is not found (ON_MEMORY will be used).".format(name))
+        backend = load_backend("ON_MEMORY")
+    storage = backend.from_options(db)
     if options.debug:
         ioloop.IOLoop.current().add_callback(init_storage_with_sample_data, storage)
 
@@ -6,7 +6,8 @@ import crypt
 from datetime import datetime
 from hmac import compare_digest as compare_hash
 import logging
-from typing import Optional
+import re
+from typing import Awaitable, List, Optional
 
 from accept_types import parse_header
 import pytz
@@ -15,9 +16,16 @@ from tornado import ioloop
 from tornado import web
 from tornado.options import options
 
-from .models import BaseBell, BaseStorage, BellResource, init_storage_with_sample_data
+from . import metrics
+from . import tracing
+from .infrastructure import BellScheduler
+from .models import BaseBell, BaseStorage, BellResource, BellResourcePriority
+from .models import init_storage_with_sample_data
 from .models import ResourceBeforePeriodError, ResourceBusyError, ResourceDisabledError
-from .models import ResourceForbiddenError, ResourceInUseError
+from .models import InvalidResourceOperationError, ResourceForbiddenError, ResourceInUseError
+from .models import RingSchedule
+from .resource_table import ResourceTable
+from .webhook import WebhookDispatcher
 
 
 class BaseRequestHandler(web.RequestHandler):
@@ -45,10 +53,41 @@ class BaseRequestHandler(web.RequestHandler):
         """Clear username from secure cookie."""
         self.clear_cookie(self.cookie_username)
 
-    def initialize(self, bell: BaseBell, database: BaseStorage) -> None:
+    def initialize(self, bell: BaseBell, database: BaseStorage,
+                   scheduler: BellScheduler, table: ResourceTable,
+                   webhook: WebhookDispatcher) -> None:
         """Set `env variables` before handle request."""
         self.bell = bell
         self.database = database
+        self.scheduler = scheduler
+        self.table = table
+        self.webhook = webhook
+        self._trace = None
+
+    def prepare(self) -> None:
+        """Start trace with ID in `X-Trace-Id` header (if valid) or new ID."""
+        trace_id = self.request.headers.get("X-Trace-Id", "")
+        self._trace = tracing.start_trace("{}.{}".format(type(self).__name__,
+                                                         self.request.method.lower()),
+                                          trace_id if re.fullmatch("[0-9a-f]{32}", trace_id)
+                                          else None)
+        if self._trace:
+            self.set_header("X-Trace-Id", self._trace.trace_id)
+
+    def render_string(self, template_name: str, **kwargs) -> bytes:
+        """Render template in span."""
+        with tracing.span("render"):
+            return super().render_string(template_name, **kwargs)
+
+    def on_finish(self) -> None:
+        """Observe request latency and write trace."""
+        timer = self.settings.get("startup_timer")
+        if timer:
+            timer.first_request()
+        metrics.HTTP_REQUEST_SECONDS.labels(type(self).__name__, self.request.method,
+                                            self.get_status()).observe(
+                                                self.request.request_time())
+        tracing.finish_trace(self._trace)
 
 
 class IndexHandler(BaseRequestHandler):
@@ -64,14 +103,12 @@ class IndexHandler(BaseRequestHandler):
         resource = None
         if token:
             try:
-                c = await self.database.get_resource_context(token)
+                resource = await self.database.get_resource(token)
             except Exception as ex:
                 logging.error("Error in getting resource '{}' ({}).".format(token, ex))
                 self.set_status(503)
                 self.write_error(503)
                 return
-            async with c:
-                resource = c.resource
         items = list()
         if options.debug:
             items = ["00000000-0000-0000-0000-000000000000",
@@ -86,7 +123,25 @@ class IndexHandler(BaseRequestHandler):
 
 
 class ResourceHandler(BaseRequestHandler):
-    """RequestHandler for managing resource."""
+    """RequestHandler for managing resource.
+
+    Response to ringing with `Idempotency-Key` header is stored, and returned to the
+    request with the same key and token without ringing again. Only final outcomes (rung,
+    not found or disabled) are stored, and the key is released after transient refusals
+    (in use, before period, busy) so that the request can be retried.
+
+    Resource is rung without lock (see `BaseStorage.ring_resource`).
+    """
+
+    _response_body: Optional[List[bytes]] = None
+    _final_outcome = False
+
+    def write(self, chunk) -> None:
+        """Write chunk (and keep it if response is stored for idempotency key)."""
+        super().write(chunk)
+        if self._response_body is not None:
+            self._response_body.append(escape.utf8(escape.json_encode(chunk)
+                                                   if isinstance(chunk, dict) else chunk))
 
     def check_xsrf_cookie(self) -> None:
         """Ignore XSRF cookie.
@@ -150,13 +205,11 @@ class ResourceHandler(BaseRequestHandler):
             self.redirect("/")
             return
         try:
-            c = await self.database.get_resource_context(token)
+            resource = await self.database.get_resource(token)
         except Exception as ex:
             logging.error("Error in getting resource '{}' ({}).".format(token, ex))
             self._write_result(500, token, None, str(ex) if options.debug else None)
             return
-        async with c:
-            resource = c.resource
         self._write_result(200 if resource else 404, token, resource)
 
     async def post(self, token: str) -> None:
@@ -189,35 +242,111 @@ class ResourceHandler(BaseRequestHandler):
                 logging.error("Error in deleting resource ({}).".format(ex))
                 self._write_result(500, token, None, str(ex) if options.debug else None)
         else:
+            key = self.request.headers.get("Idempotency-Key")
+            if key is None:
+                await self._ring(token)
+            elif not re.fullmatch("[\x21-\x7e]{1,255}", key):
+                self._write_result(400, token, None, "Idempotency-Keyが不正です。")
+            else:
+                await self._ring_once(token, "{}:{}".format(token, key))
+
+    async def _ring_once(self, token: str, key: str) -> None:
+        """Ring resource, or write the stored response if key is already used."""
+        try:
+            response = await self.database.reserve_response(
+                key, options.idempotency_reserve_expire)
+        except Exception as ex:
+            logging.error("Error in reserving idempotency key '{}' ({}).".format(key, ex))
+            self._write_result(500, token, None, str(ex) if options.debug else None)
+            return
+        if response is not None:
+            if "code" not in response:
+                self._write_result(409, token, None,
+                                   "同じIdempotency-Keyのリクエストを処理中です。")
+                return
+            self.set_status(response["code"])
+            self.set_header("Content-Type", response["content_type"])
+            self.set_header("Idempotent-Replayed", "true")
+            self.finish(response["body"])
+            return
+        self._response_body = list()
+        try:
+            await self._ring(token)
+        finally:
             try:
-                try:
-                    c = await self.database.get_resource_context(token)
-                except Exception as ex:
-                    logging.error("Error in getting resource '{}' ({}).".format(token, ex))
-                    self._write_result(500, token, None, str(ex) if options.debug else None)
-                    return
-                async with c:
-                    resource = c.resource
-                    if not resource:
-                        self._write_result(404, token, None)
-                        return
-                    if not resource.api:
-                        super().check_xsrf_cookie()
-                    try:
-                        resource.ring(self.bell)
-                    except (ResourceBeforePeriodError, ResourceDisabledError) as ex:
-                        self._write_result(403, token, resource, ex.msg)
-                    except ResourceInUseError as ex:
-                        self._write_result(429, token, resource, ex.msg)
-                    except ResourceBusyError as ex:
-                        self._write_result(503, token, resource, ex.msg)
-                    except ResourceForbiddenError as ex:
-                        self._write_result(503, token, resource, ex.msg)
-                    else:
-                        self._write_result(202, token, resource)
+                if self._final_outcome:
+                    response = {"code": self.get_status(),
+                                "content_type": self._headers.get("Content-Type"),
+                                "body": b"".join(self._response_body).decode()}
+                    await self.database.store_response(key, response,
+                                                       options.idempotency_expire)
+                else:
+                    await self.database.release_response(key)
+            except Exception as ex:
+                logging.error("Error in storing response of '{}' ({}).".format(key, ex))
+            self._response_body = None
+
+    async def _ring(self, token: str) -> None:
+        """Ring resource and write the result."""
+        attached = self.bell.attach(token)
+        if attached:
+            await self._wait_coalesced(token, *attached)
+            return
+        try:
+            try:
+                resource = await self.database.get_resource(token)
             except Exception as ex:
-                logging.error("Error in ringing resource ({}).".format(ex))
+                logging.error("Error in getting resource '{}' ({}).".format(token, ex))
                 self._write_result(500, token, None, str(ex) if options.debug else None)
+                return
+            if resource and not resource.api:
+                super().check_xsrf_cookie()
+            if resource:
+                resource, error = await self.database.ring_resource(resource, self.bell)
+            if not resource:
+                self._final_outcome = True
+                self._write_result(404, token, None)
+            elif error:
+                self._write_ring_error(token, resource, error)
+            else:
+                self._final_outcome = True
+                self._write_result(202, token, resource)
+        except Exception as ex:
+            logging.error("Error in ringing resource ({}).".format(ex))
+            self._write_result(500, token, None, str(ex) if options.debug else None)
+
+    def _write_ring_error(self, token: str, resource: BellResource,
+                          ex: InvalidResourceOperationError) -> None:
+        """Write the reason why resource cannot be rung."""
+        if isinstance(ex, ResourceDisabledError):
+            self._final_outcome = True
+            self._write_result(403, token, resource, ex.msg)
+        elif isinstance(ex, ResourceBeforePeriodError):
+            self._write_result(403, token, resource, ex.msg)
+        elif isinstance(ex, ResourceInUseError):
+            self._write_result(429, token, resource, ex.msg)
+        elif isinstance(ex, (ResourceBusyError, ResourceForbiddenError)):
+            self._write_result(503, token, resource, ex.msg)
+        else:
+            raise ex
+
+    async def _wait_coalesced(self, token: str, resource: BellResource,
+                              result: Awaitable[bool]) -> None:
+        """Wait for the result of ringing coalesced resource and write it."""
+        try:
+            if not resource.api:
+                super().check_xsrf_cookie()
+            ok = await result
+            resource = await self.database.get_resource(token) or resource
+        except Exception as ex:
+            logging.error("Error in ringing resource ({}).".format(ex))
+            self._write_result(500, token, None, str(ex) if options.debug else None)
+            return
+        if ok:
+            self._final_outcome = True
+            self._write_result(200, token, resource)
+        else:
+            self._write_result(503, token, resource, "ベルを鳴らせませんでした。")
 
 
 class AdminLoginHandler(BaseRequestHandler):
@@ -256,57 +385,97 @@ class AdminLogoutHandler(BaseRequestHandler):
 class AdminTokenHandler(BaseRequestHandler):
     """RequestHandler for managing resource as admin."""
 
+    def _render_list(self, new_token: Optional[str]=None, old_token: Optional[str]=None,
+                     failed_in_delete: bool=False, failed_in_create: bool=False,
+                     failed_in_schedule: bool=False) -> None:
+        """Render resource list page with result of the last action.
+
+        Resources are filtered by ResourceTable if `filter` argument is valid,
+        and only the selected ones are read from storage.
+        """
+        now = datetime.now(pytz.utc).timestamp()
+        filter_name = self.get_argument("filter", "")
+        if filter_name in ResourceTable.FILTERS:
+            items = self.database.get_resources(
+                self.table.select(filter_name, now, options.expiring_soon))
+        else:
+            filter_name = ""
+            items = self.database.get_all_resources()
+        self.render("generate.html", items=items, schedules=self.scheduler.get_all_schedules(),
+                    stats=self.table.stats(now, options.expiring_soon), filter_name=filter_name,
+                    events=self.database.get_events(limit=options.ring_history_display),
+                    trace_mode=tracing.get_mode(),
+                    new_token=new_token, old_token=old_token,
+                    failed_in_delete=failed_in_delete, failed_in_create=failed_in_create,
+                    failed_in_schedule=failed_in_schedule,
+                    tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
+
     @web.authenticated
     def get(self) -> None:
         """Render resource list page."""
         try:
-            items = self.database.get_all_resources()
+            self._render_list()
         except Exception as ex:
             logging.error("Error in getting resources ({}).".format(ex))
             self.set_status(500)
             self.write_error(500)
             return
-        self.render("generate.html", items=items, new_token=None, old_token=None,
-                    failed_in_delete=False, failed_in_create=False,
-                    tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
 
     @web.authenticated
     async def post(self) -> None:
-        """Create or delete resource."""
-        if self.get_argument("action", "") == "delete":
+        """Create or delete resource, or schedule ringing resource."""
+        action = self.get_argument("action", "")
+        if action == "delete":
             try:
                 token = self.get_argument("token")
                 r = await self.database.delete_resource(token)
-                items = self.database.get_all_resources()
-                self.render("generate.html", items=items,
-                            new_token=None, old_token=r.uuid,
-                            failed_in_delete=False, failed_in_create=False,
-                            tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
+                self._render_list(old_token=r.uuid)
             except KeyError as ex:
                 logging.warning(str(ex))
-                token = self.get_argument("token", None)
-                items = self.database.get_all_resources()
-                self.render("generate.html", items=items,
-                            new_token=None, old_token=token,
-                            failed_in_delete=True, failed_in_create=False,
-                            tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
+                self._render_list(old_token=self.get_argument("token", None),
+                                  failed_in_delete=True)
             except Exception as ex:
                 logging.error("Error in deleting resource ({}).".format(ex))
-                token = self.get_argument("token", None)
-                items = self.database.get_all_resources()
-                self.render("generate.html", items=items,
-                            new_token=None, old_token=token,
-                            failed_in_delete=True, failed_in_create=False,
-                            tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
+                self._render_list(old_token=self.get_argument("token", None),
+                                  failed_in_delete=True)
+        elif action == "schedule":
+            token = self.get_argument("token", "")
+            fire_at_date = self.get_argument("fire_at_date")
+            fire_at_time = self.get_argument("fire_at_time") or "00:00:00"
+            try:
+                if not await self.database.get_resource(token):
+                    raise KeyError("Resource '{}' is not found.".format(token))
+                s = RingSchedule(token,
+                                 datetime.strptime("{} {}".format(fire_at_date, fire_at_time),
+                                                   "%Y-%m-%d %H:%M:%S"))
+                await self.scheduler.add(s)
+                self._render_list()
+            except Exception as ex:
+                logging.warning(str(ex))
+                self._render_list(failed_in_schedule=True)
+        elif action == "unschedule":
+            try:
+                await self.scheduler.remove(self.get_argument("schedule"))
+                self._render_list()
+            except Exception as ex:
+                logging.warning(str(ex))
+                self._render_list(failed_in_schedule=True)
         else:
             milliseconds = self.get_argument("milliseconds")
+            pattern = self.get_argument("pattern", "")
             not_before_date = self.get_argument("not_before_date")
             not_before_time = self.get_argument("not_before_time") or "00:00:00"
             not_after_date = self.get_argument("not_after_date")
             not_after_time = self.get_argument("not_after_time") or "23:59:59"
             sticky = self.get_argument("sticky", "")
             api = self.get_argument("api", "")
+            coalesce = self.get_argument("coalesce", "")
+            callback_url = self.get_argument("callback_url", "").strip()
+            priority = self.get_argument("priority", "")
             try:
+                pattern = BellResource.parse_pattern(pattern) if pattern.strip() else None
+                if pattern:
+                    milliseconds = sum(pattern)
                 if int(milliseconds) <= 0:
                     msg = "milliseconds must be positive int (actual: {})"
                     raise ValueError(msg.format(milliseconds))
@@ -319,15 +488,80 @@ class AdminTokenHandler(BaseRequestHandler):
                                                    "%Y-%m-%d %H:%M:%S")
                                  if not_after_date else None,
                                  bool(sticky),
-                                 bool(api))
+                                 bool(api),
+                                 pattern,
+                                 bool(coalesce),
+                                 callback_url or None,
+                                 BellResourcePriority[priority] if priority else None)
                 await self.database.create_resource(r)
-                items = self.database.get_all_resources()
-                self.render("generate.html", items=items, new_token=r.uuid, old_token=None,
-                            failed_in_delete=False, failed_in_create=False,
-                            tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
+                self._render_list(new_token=r.uuid)
             except Exception as ex:
                 logging.warning(str(ex))
-                items = self.database.get_all_resources()
-                self.render("generate.html", items=items, new_token=None, old_token=None,
-                            failed_in_delete=False, failed_in_create=True,
-                            tz=datetime.now(pytz.timezone(options.timezone)).strftime("%z"))
+                self._render_list(failed_in_create=True)
+
+
+class AdminTraceHandler(BaseRequestHandler):
+    """RequestHandler for switching tracing mode as admin."""
+
+    @web.authenticated
+    def get(self) -> None:
+        """Write current tracing mode in json."""
+        self.write({"mode": tracing.get_mode()})
+
+    @web.authenticated
+    def post(self) -> None:
+        """Switch tracing mode."""
+        try:
+            tracing.set_mode(self.get_argument("mode"))
+        except ValueError as ex:
+            logging.warning(str(ex))
+            self.set_status(400)
+            self.write_error(400)
+            return
+        self.redirect("/admin/")
+
+
+class AdminHistoryHandler(BaseRequestHandler):
+    """RequestHandler for querying ring history as admin."""
+
+    @web.authenticated
+    def get(self) -> None:
+        """Write ring events filtered by `token`, `since` and `until` in json."""
+        try:
+            since, until = [datetime.fromisoformat(self.get_argument(x))
+                            if self.get_argument(x, "") else None for x in ("since", "until")]
+            since, until = [pytz.timezone(options.timezone).localize(x)
+                            if x and x.tzinfo is None else x for x in (since, until)]
+            limit = int(self.get_argument("limit", str(options.ring_history_display)))
+        except ValueError as ex:
+            logging.warning(str(ex))
+            self.set_status(400)
+            self.write_error(400)
+            return
+        try:
+            events = self.database.get_events(self.get_argument("token", None),
+                                              since, until, limit)
+        except Exception as ex:
+            logging.error("Error in getting ring events ({}).".format(ex))
+            self.set_status(500)
+            self.write_error(500)
+            return
+        self.write({"events": [x.to_dict() for x in events]})
+
+
+class AdminStatsHandler(BaseRequestHandler):
+    """RequestHandler for statistics of resources as admin."""
+
+    @web.authenticated
+    def get(self) -> None:
+        """Write statistics of resources in json."""
+        self.write(self.table.stats(datetime.now(pytz.utc).timestamp(), options.expiring_soon))
+
+
+class MetricsHandler(BaseRequestHandler):
+    """RequestHandler for scraping metrics."""
+
+    def get(self) -> None:
+        """Write metrics in Prometheus text format."""
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.expose())
@@ -5,93 +5,489 @@
 from __future__ import annotations
 
 import asyncio
+from collections import deque, OrderedDict
 import copy
-from datetime import datetime
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+import dbm
+import heapq
 import json
 import logging
-from threading import Lock
-from typing import Dict, List, Optional
-
-import redis
+import os
+import pathlib
+import signal
+import tempfile
+import time
+from typing import Awaitable, Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+import pytz
 from tornado import ioloop
 from tornado.options import options
 
-from .models import BaseBell, BaseContext, BaseStorage, BellResource
-from .models import DataBaseAddress, ResourceBusyError
+from . import metrics
+from . import tracing
+from .models import BaseBell, BaseContext, BaseStorage, BellResource, BellResourcePriority
+from .models import DataBaseAddress, InvalidResourceOperationError, ResourceBusyError
+from .models import ResourceForbiddenError, VersionConflictError
+from .models import RingEvent, RingSchedule
+
+
+class RingQueue(asyncio.Queue):
+    """Queue of ring entries which gets the entry of the highest priority first.
+
+    Entries are `(resource, enqueued_at, trace)`. Priority of waiting entry is raised by
+    one class every `aging` seconds (so low priority entries are not starved), and entries
+    of the same priority are got in order of `enqueued_at`. `None` (stop the worker) is
+    got after all entries.
+    """
+
+    def __init__(self, aging: float=0) -> None:
+        """Initialize with seconds to raise priority of waiting entry (0 to disable)."""
+        self.aging = aging
+        super().__init__()
+
+    def _init(self, maxsize: int) -> None:
+        self._queue: List[Optional[Tuple[BellResource, float, object]]] = list()
+
+    def _put(self, item: Optional[Tuple[BellResource, float, object]]) -> None:
+        self._queue.append(item)
+
+    def _get(self) -> Optional[Tuple[BellResource, float, object]]:
+        now = time.perf_counter()
+        i = min(range(len(self._queue)),
+                key=lambda i: ((float("inf"), 0) if self._queue[i] is None else
+                               (self._rank(self._queue[i], now), self._queue[i][1])))
+        return self._queue.pop(i)
+
+    def _rank(self, item: Tuple[BellResource, float, object], now: float) -> int:
+        """Return priority of entry raised by its waiting time."""
+        rank = item[0].priority.value
+        if self.aging > 0:
+            rank -= int((now - item[1]) / self.aging)
+        return rank
 
 
 class MaruBell(BaseBell):
-    """Bell implementation with physical bell."""
+    """Bell implementation with physical bell.
+
+    While the bell is ringing, a resource is queued only if fewer than
+    `ring_queue_limit_<priority>` resources are waiting, so lower priority (with smaller
+    limit) is refused first under load. Waiting resources ring in order of priority (see
+    `RingQueue`).
+
+    Ring of *coalesce* resource can be attached by other requests within
+    `coalesce_window` seconds after it was queued.
+
+    Ring command runs in its own process group, which is terminated (and killed
+    `KILL_TIMEOUT` seconds later) if the command does not finish in its duration plus
+    `ring_timeout_grace` seconds. Then, or if the worker
+    crashed, the bell is degraded and refuses rings for `ring_degraded_cooldown` seconds.
+
+    After `close` is called, the bell refuses new rings and the worker stops when the
+    queue is drained.
+    """
+
+    KILL_TIMEOUT = 3
+    RESTART_DELAY = 1
 
     def __init__(self, database: BaseStorage) -> None:
         """Initialize with database."""
         super().__init__(database)
-        self._ring_queue = asyncio.Queue(1)
-        ioloop.IOLoop.current().add_callback(self.worker)
+        self._ring_queue = RingQueue(options.ring_priority_aging)
+        self._coalescing: Dict[str, Tuple[float, BellResource, asyncio.Future]] = dict()
+        self._current: Optional[BellResource] = None
+        self._degraded: Optional[Tuple[float, str]] = None
+        self._hold: Optional[Awaitable] = None
+        self._closing = False
+        ioloop.IOLoop.current().add_callback(self.supervise)
+
+    def _degrade(self, reason: str) -> None:
+        """Refuse rings for `ring_degraded_cooldown` seconds."""
+        self._degraded = (time.monotonic() + options.ring_degraded_cooldown, reason)
+        msg = "Bell is degraded for {} sec ({})."
+        logging.error(msg.format(options.ring_degraded_cooldown, reason))
+        metrics.BELL_DEGRADED.labels().set(1)
+
+    def get_degraded_reason(self) -> Optional[str]:
+        """Return the reason if the bell is degraded now."""
+        if self._degraded and time.monotonic() < self._degraded[0]:
+            return self._degraded[1]
+        if self._degraded:
+            self._degraded = None
+            metrics.BELL_DEGRADED.labels().set(0)
+        return None
+
+    def get_queue_limit(self, priority: BellResourcePriority) -> int:
+        """Return max number of waiting resources to accept resource of priority."""
+        return getattr(options, "ring_queue_limit_{}".format(priority.name.lower()))
+
+    def check(self, resource: Optional[BellResource]=None) -> None:
+        """Check if bell is not degraded and queue can accept resource.
+
+        Without resource, check if bell is idle.
+        """
+        if self._closing:
+            raise ResourceForbiddenError("サーバーを停止しています。")
+        reason = self.get_degraded_reason()
+        if reason:
+            raise ResourceForbiddenError(reason)
+        if not self._ring_queue._unfinished_tasks:
+            return
+        if resource is None or self._ring_queue.qsize() >= self.get_queue_limit(
+                resource.priority):
+            if resource is not None:
+                metrics.RING_SHED_TOTAL.labels(resource.priority.name).inc()
+            raise ResourceBusyError
 
     def ring(self, resource: BellResource) -> None:
         """Add resource to queue."""
+        self.check(resource)
+        self._ring_queue.put_nowait((resource, time.perf_counter(), tracing.current()))
+        if resource.coalesce:
+            self._coalescing[resource.uuid] = (time.perf_counter(), copy.deepcopy(resource),
+                                               asyncio.get_running_loop().create_future())
+        metrics.RING_QUEUE_DEPTH.labels().set(self._ring_queue.qsize())
+
+    def attach(self, key: str) -> Optional[Tuple[BellResource, asyncio.Future]]:
+        """Return resource and its result if it is ringing within `coalesce_window`."""
+        entry = self._coalescing.get(key)
+        if entry is None or time.perf_counter() - entry[0] > options.coalesce_window:
+            return None
+        metrics.RING_RESULT_TOTAL.labels("coalesced").inc()
+        return entry[1], asyncio.shield(entry[2])
+
+    def _notify(self, key: str, ok: bool) -> None:
+        """Notify result to coalesced requests."""
+        entry = self._coalescing.pop(key, None)
+        if entry:
+            entry[2].set_result(ok)
+
+    def hold(self, until: Awaitable) -> None:
+        """Do not start ringing until `until` is done (queued resources wait)."""
+        self._hold = until
+
+    async def close(self, timeout: float) -> None:
+        """Refuse new rings, wait for queued rings and stop the worker.
+
+        Resources still waiting after `timeout` seconds fail without ringing (the ringing
+        one is finished by `ring_timeout_grace`).
+        """
+        self._closing = True
         try:
-            if self._ring_queue._unfinished_tasks:
-                raise ResourceBusyError
-            self._ring_queue.put_nowait(resource)
-        except asyncio.QueueFull:
-            raise ResourceBusyError
+            await asyncio.wait_for(self._ring_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            while not self._ring_queue.empty():
+                entry = self._ring_queue.get_nowait()
+                if entry is not None:
+                    await self._drop(*entry)
+                self._ring_queue.task_done()
+            await self._ring_queue.join()
+        await self._ring_queue.put(None)
+
+    async def _drop(self, item: BellResource, enqueued_at: float, parent) -> None:
+        """Fail queued resource without ringing."""
+        logging.warning("Resource '{}' was not rung before shutdown.".format(item.uuid))
+        await self._finish(item, False)
+        self._notify(item.uuid, False)
+        now = datetime.now(pytz.utc)
+        event = RingEvent(item.uuid, now - timedelta(seconds=time.perf_counter() - enqueued_at),
+                          now, now, "fail", None)
+        await self._append_event(event)
+        self._ring_finished(event, item)
+
+    async def execute(self, resource: BellResource) -> int:
+        """Run ring command for the resource and return its exit status.
+
+        The whole on/off sequence of pattern resource is passed to one command.
+        """
+        sequence = resource.get_sequence()
+        if resource.pattern and sum(sequence) > options.ring_pattern_max_milliseconds:
+            msg = "Pattern of '{}' is longer than {} ms."
+            logging.error(msg.format(resource.uuid, options.ring_pattern_max_milliseconds))
+            return 1
+        p = await asyncio.create_subprocess_exec(str(options.ring_command),
+                                                 *[str(x) for x in sequence],
+                                                 start_new_session=True)
+        timeout = sum(sequence) / 1000 + options.ring_timeout_grace
+        try:
+            return await asyncio.wait_for(p.wait(), timeout)
+        except asyncio.TimeoutError:
+            msg = "Ring command for '{}' did not finish in {:.1f} sec."
+            logging.error(msg.format(resource.uuid, timeout))
+            metrics.RING_RESULT_TOTAL.labels("timeout").inc()
+            await self._kill_group(p.pid, resource)
+            await p.wait()
+            self._degrade("ベルが応答しません。")
+            raise
+
+    async def _kill_group(self, pgid: int, resource: BellResource) -> None:
+        """Terminate process group of ring command, and kill it if it is still alive."""
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        deadline = time.perf_counter() + self.KILL_TIMEOUT
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+            try:
+                os.killpg(pgid, 0)
+            except ProcessLookupError:
+                return
+        logging.error("Ring command for '{}' is killed.".format(resource.uuid))
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    async def _append_event(self, event: RingEvent) -> None:
+        """Append ring event to history out of the worker."""
+        try:
+            await self.database.append_event(event)
+        except Exception as ex:
+            logging.error("Error in appending ring event of '{}' ({}).".format(event.token, ex))
+
+    async def supervise(self) -> None:
+        """Run worker, and restart it if it crashed."""
+        while True:
+            try:
+                await self.worker()
+                return
+            except Exception as ex:
+                logging.error("Worker crashed ({}).".format(ex))
+                self._degrade("ベルの制御でエラーが発生しました。")
+                item, self._current = self._current, None
+                if item:
+                    await self._finish(item, False)
+                    self._notify(item.uuid, False)
+            await asyncio.sleep(self.RESTART_DELAY)
+            logging.warning("Worker is restarted.")
+
+    async def _finish(self, item: BellResource, ok: bool) -> None:
+        """Write back result of ringing to the resource (retry if it was updated)."""
+        resource = item
+        for _ in range(self.database.CAS_RETRY):
+            try:
+                if ok:
+                    resource.success()
+                else:
+                    resource.fail()
+                await self.database.update_resource(resource)
+            except VersionConflictError as ex:
+                resource = ex.resource
+                continue
+            except KeyError:
+                logging.warning("Resource '{}' was deleted while ringing.".format(item.uuid))
+            except Exception as ex:
+                logging.error("{}: {}".format(ex, item.uuid))
+            else:
+                metrics.RING_RESULT_TOTAL.labels("success" if ok else "fail").inc()
+            return
+        logging.error("Result of '{}' was not written (updated by others).".format(item.uuid))
 
     async def worker(self) -> None:
         """Ring bell and notify result to the resource."""
         while True:
             try:
-                item = await self._ring_queue.get()
-                if item is None:
+                if self._hold is not None:
+                    hold, self._hold = self._hold, None
+                    await hold
+                entry = await self._ring_queue.get()
+                if entry is None:
                     break
+                item, enqueued_at, parent = entry
             except Exception as ex:
                 logging.error(str(ex))
                 continue
             try:
-                p = await asyncio.create_subprocess_exec(str(options.ring_command),
-                                                         str(item.milliseconds))
-                await p.wait()
-            except Exception as ex:
-                logging.error(str(ex))
+                self._current = item
+                trace = (tracing.start_trace("MaruBell.worker", parent.trace_id, sampled=True)
+                         if parent else None)
+                metrics.RING_QUEUE_DEPTH.labels().set(self._ring_queue.qsize())
+                start = time.perf_counter()
+                started_at = datetime.now(pytz.utc)
+                metrics.RING_QUEUE_WAIT_SECONDS.labels().observe(start - enqueued_at)
+                if trace:
+                    trace.add("queue_wait", enqueued_at, start)
+                returncode = None
                 try:
-                    c = await self.database.get_resource_context(item.uuid)
-                    async with c:
-                        if c.resource:
-                            c.resource.fail()
-                        else:
-                            msg = "Resource was deleted while ringing: {}".format(item.uuid)
-                            logging.warning(msg)
+                    with tracing.span("ring_command"):
+                        returncode = await self.execute(item)
                 except Exception as ex:
-                    logging.error("{}: {}".format(ex, item.uuid))
-            else:
-                try:
-                    c = await self.database.get_resource_context(item.uuid)
-                    async with c:
-                        if not c.resource:
-                            msg = "Resource '{}' was deleted while ringing.".format(item.uuid)
-                            logging.warning(msg)
-                            msg = "Worker command for '{}' returned {}."
-                            logging.warning(msg.format(item.uuid, p.returncode))
-                        elif p.returncode == 0:
-                            c.resource.success()
-                        else:
-                            c.resource.fail()
-                except Exception as ex:
-                    logging.error("{}: {}".format(ex, item.uuid))
-            self._ring_queue.task_done()
+                    logging.error("Error in ringing '{}' ({!r}).".format(item.uuid, ex))
+                metrics.RING_EXECUTION_SECONDS.labels().observe(time.perf_counter() - start)
+                if returncode:
+                    msg = "Worker command for '{}' returned {}."
+                    logging.warning(msg.format(item.uuid, returncode))
+                ok = returncode == 0
+                await self._finish(item, ok)
+                self._current = None
+                self._notify(item.uuid, ok)
+                event = RingEvent(item.uuid, started_at - timedelta(seconds=start - enqueued_at),
+                                  started_at, datetime.now(pytz.utc), "success" if ok else "fail",
+                                  returncode)
+                ioloop.IOLoop.current().add_callback(self._append_event, event)
+                self._ring_finished(event, item)
+                tracing.finish_trace(trace)
+            finally:
+                self._ring_queue.task_done()
+
+
+class BellScheduler(object):
+    """Timer which rings bell by scheduled resources.
+
+    All pending schedules share one heap and one IOLoop timeout for the earliest one.
+    """
+
+    MAX_SLEEP = 60
+    RETRY_TIME = 1
+    TOLERANCE = 1
+
+    def __init__(self, bell: BaseBell, database: BaseStorage) -> None:
+        """Initialize with bell and database, then load schedules from database."""
+        self.bell = bell
+        self.database = database
+        self._heap: List[Tuple[float, str]] = list()
+        self._schedules: Dict[str, RingSchedule] = dict()
+        self._timeout = None
+        self._timeout_at: Optional[float] = None
+        self._stopped = False
+        ioloop.IOLoop.current().add_callback(self.load)
+
+    async def load(self) -> None:
+        """Load schedules from database and apply misfire policy to overdue ones."""
+        try:
+            schedules = self.database.get_all_schedules()
+        except Exception as ex:
+            logging.error("Error in loading schedules ({}).".format(ex))
+            return
+        for x in schedules:
+            self._push(x)
+        self._arm()
+
+    def get_all_schedules(self) -> List[RingSchedule]:
+        """Get pending schedule list in order of fire time."""
+        return list(sorted(self._schedules.values(), key=lambda x: x.timestamp()))
+
+    async def add(self, schedule: RingSchedule) -> None:
+        """Store schedule and arm timer."""
+        await self.database.create_schedule(schedule)
+        self._push(schedule)
+        self._arm()
+
+    async def remove(self, key: str) -> RingSchedule:
+        """Delete schedule (the heap entry will be skipped when it pops)."""
+        self._schedules.pop(key, None)
+        return await self.database.delete_schedule(key)
+
+    def _push(self, schedule: RingSchedule) -> None:
+        self._schedules[schedule.uuid] = schedule
+        heapq.heappush(self._heap, (schedule.timestamp(), schedule.uuid))
+
+    def stop(self) -> None:
+        """Stop firing schedules (they are kept in database for the next start)."""
+        self._stopped = True
+        if self._timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+            self._timeout_at = None
+
+    def _arm(self) -> None:
+        """Set IOLoop timeout for the earliest schedule."""
+        if self._stopped:
+            return
+        while self._heap and self._heap[0][1] not in self._schedules:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        delay = min(self.MAX_SLEEP, max(0, self._heap[0][0] - datetime.now().timestamp()))
+        current = ioloop.IOLoop.current()
+        deadline = current.time() + delay
+        if self._timeout is not None:
+            if self._timeout_at <= deadline:
+                return
+            current.remove_timeout(self._timeout)
+        self._timeout = current.call_at(deadline, self._fire)
+        self._timeout_at = deadline
+
+    def _fire(self) -> None:
+        """Pop all due schedules and ring them."""
+        self._timeout = None
+        self._timeout_at = None
+        now = datetime.now().timestamp()
+        while self._heap and self._heap[0][0] <= now:
+            _, key = heapq.heappop(self._heap)
+            schedule = self._schedules.get(key)
+            if schedule:
+                ioloop.IOLoop.current().add_callback(self._ring, schedule)
+        self._arm()
+
+    def _is_missed(self, schedule: RingSchedule) -> bool:
+        """Check if schedule is too late to ring according to misfire policy."""
+        late = datetime.now().timestamp() - schedule.timestamp()
+        if late <= self.TOLERANCE:
+            return False
+        elif options.schedule_misfire == "SKIP":
+            return True
+        else:
+            return late > options.schedule_misfire_grace
+
+    async def _ring(self, schedule: RingSchedule) -> None:
+        """Ring bell by scheduled resource and delete the schedule.
+
+        While the bell is busy, degraded or closing, retry it until it is missed.
+        """
+        if schedule.uuid not in self._schedules or self._stopped:
+            return
+        if self._is_missed(schedule):
+            msg = "Schedule '{}' for '{}' at {} was missed."
+            logging.warning(msg.format(schedule.uuid, schedule.token, schedule.fire_at))
+        else:
+            try:
+                resource = await self.database.get_resource(schedule.token)
+                error = None
+                if resource:
+                    resource, error = await self.database.ring_resource(resource, self.bell)
+                if not resource:
+                    msg = "Resource '{}' was deleted before schedule '{}'."
+                    logging.warning(msg.format(schedule.token, schedule.uuid))
+                elif error:
+                    raise error
+            except (ResourceBusyError, ResourceForbiddenError):
+                ioloop.IOLoop.current().call_later(self.RETRY_TIME, self._ring, schedule)
+                return
+            except InvalidResourceOperationError as ex:
+                if self._stopped:
+                    return
+                msg = "Schedule '{}' for '{}' was not rung ({})."
+                logging.warning(msg.format(schedule.uuid, schedule.token, ex.msg))
+            except Exception as ex:
+                logging.error("Error in ringing schedule '{}' ({}).".format(schedule.uuid, ex))
+        try:
+            await self.remove(schedule.uuid)
+        except KeyError:
+            pass
+        except Exception as ex:
+            logging.error("Error in deleting schedule '{}' ({}).".format(schedule.uuid, ex))
 
 
-memory_storage_resource: Dict[str, BellResource] = dict()
-memory_storage_lock: Dict[str, Lock] = dict()
+memory_storage_resource: OrderedDict[str, BellResource] = OrderedDict()
+memory_storage_lock: Dict[str, asyncio.Lock] = dict()
+memory_storage_spilled: Set[str] = set()
+memory_storage_schedule: Dict[str, RingSchedule] = dict()
+memory_storage_index: List[Tuple[float, str]] = list()
+memory_storage_response: OrderedDict[str, Tuple[float, dict]] = OrderedDict()
+memory_storage_event: Deque[Tuple[float, int, RingEvent]] = deque()
+memory_storage_event_index: Dict[str, Deque[Tuple[float, int]]] = dict()
 
 
 class MemoryContext(BaseContext):
     """With-statement context which processes MemoryStorage with specified resource."""
 
-    def __init__(self, resource: BellResource, lock: Optional[Lock]=None) -> None:
-        """Initialize with BellResource and releasable lock."""
+    def __init__(self, resource: BellResource,
+                 storage: MemoryStorage, lock: Optional[asyncio.Lock]=None) -> None:
+        """Initialize with BellResource, MemoryStorage and releasable lock."""
         super().__init__(resource)
+        self._storage = storage
         self._lock = lock
 
     async def __aenter__(self):
@@ -103,160 +499,418 @@ class MemoryContext(BaseContext):
         ex = ex_type or ex_value or trace
         if self._lock:
             self.resource.clear_validation_cache()
-            if not ex:
-                memory_storage_resource[self.resource.uuid] = self.resource
-            self._lock.release()
+            try:
+                if not ex:
+                    self._storage._compare_and_set(self.resource)
+            finally:
+                self._lock.release()
         return not ex
 
 
 class MemoryStorage(BaseStorage):
-    """Database implementation with on-memory dict."""
+    """Database implementation with on-memory dict.
+
+    If `snapshot` path is specified, the records are restored from the snapshot file and
+    its change log (`snapshot` + ".log") on initialization. Resources which were ringing
+    then are failed as if the ring command failed. Every change is appended to the change
+    log, and the snapshot is rewritten every `snapshot_interval` seconds and on `close`.
+
+    If `max_resources` is positive, resources on memory are kept in order of last use,
+    and the least recently used ones over the limit are moved to `spill` file (dbm) and
+    paged in again when they are used. USED resources are moved to the least recently
+    used end, and resources in use or locked are never moved. Records in the spill file
+    are overwritten but never deleted (only keys in `memory_storage_spilled` are valid),
+    because deleting is slow in some dbm implementations. The spill file is only a cache
+    of the snapshot and is recreated on initialization.
+
+    Responses of idempotency keys are kept only on memory (up to `max_responses` keys).
+    Ring events are kept only on memory in a ring buffer (up to `max_events` events) with
+    index of (finished_at, sequence number) by token.
+    """
+
+    SNAPSHOT_VERSION = 1
 
     def __init__(self, addr: DataBaseAddress,
-                 initial_resource_list: Optional[List[BellResource]]=None) -> None:
-        """Initialize with initial resource list."""
+                 initial_resource_list: Optional[List[BellResource]]=None,
+                 snapshot: Optional[str]=None, snapshot_interval: int=0,
+                 max_responses: int=10000, max_events: int=10000,
+                 max_resources: int=0, spill: Optional[str]=None) -> None:
+        """Initialize with initial resource list, snapshot file and spill file."""
         super().__init__(addr)
+        self._max_responses = max_responses
+        self._max_events = max_events
+        self._max_resources = max(0, max_resources)
+        self._spill = None
+        if self._max_resources:
+            spill = spill or os.path.join(tempfile.mkdtemp(prefix="maruberu-"), "spill")
+            self._spill = dbm.open(spill, "n")
+            logging.info("Resources over {} are moved to '{}'.".format(max_resources, spill))
+        self._snapshot = pathlib.Path(snapshot) if snapshot else None
+        self._journal = None
+        self._snapshot_callback = None
+        if self._snapshot:
+            self.restore()
+            self._journal = open(self._journal_path(), "a", buffering=1)
+            self._fail_interrupted()
+            if snapshot_interval > 0:
+                self._snapshot_callback = ioloop.PeriodicCallback(self.save_snapshot,
+                                                                  snapshot_interval * 1000)
+                self._snapshot_callback.start()
         for r in (initial_resource_list or []):
-            self.create_resource(r)
-
+            if r.uuid not in memory_storage_resource:
+                self._insert(copy.deepcopy(r))
+
+    @classmethod
+    def from_options(cls, addr: DataBaseAddress) -> MemoryStorage:
+        """Create database with address and snapshot options."""
+        return cls(addr, snapshot=options.memory_snapshot or None,
+                   snapshot_interval=options.memory_snapshot_interval,
+                   max_responses=options.idempotency_max_keys,
+                   max_events=options.ring_history_size,
+                   max_resources=options.memory_max_resources,
+                   spill=options.memory_spill_file or None)
+
+    def _insert(self, obj: BellResource) -> None:
+        self._store(obj)
+        self._count()
+        insort(memory_storage_index, (obj.created_at.timestamp(), obj.uuid))
+        self._write_journal({"op": "put", "resource": obj.to_dict()})
+        self._changed(obj.uuid, obj)
+
+    def _store(self, obj: BellResource, cold: bool=False) -> None:
+        """Put resource on memory as the most (or least if `cold`) recently used one."""
+        memory_storage_resource[obj.uuid] = obj
+        memory_storage_resource.move_to_end(obj.uuid, last=not cold)
+        if obj.uuid not in memory_storage_lock:
+            memory_storage_lock[obj.uuid] = asyncio.Lock()
+        if self._max_resources:
+            self._evict(obj.uuid)
+
+    def _evict(self, keep: str) -> None:
+        """Move least recently used resources over the limit (except `keep`) to spill file."""
+        while len(memory_storage_resource) > self._max_resources:
+            for key, r in memory_storage_resource.items():
+                if key != keep and not r.is_using() and not memory_storage_lock[key].locked():
+                    break
+            else:
+                break
+            del memory_storage_resource[key]
+            del memory_storage_lock[key]
+            self._spill[key] = json.dumps(r.to_dict(), separators=(",", ":"))
+            memory_storage_spilled.add(key)
+            metrics.MEMORY_STORAGE_PAGING_TOTAL.labels("out").inc()
+        self._count()
+
+    def _load(self, key: str) -> Optional[BellResource]:
+        """Return resource on memory (and page it in if it is in spill file)."""
+        r = memory_storage_resource.get(key)
+        if r is not None:
+            memory_storage_resource.move_to_end(key)
+            return r
+        if key not in memory_storage_spilled:
+            return None
+        r = BellResource.from_dict(json.loads(self._spill[key]))
+        memory_storage_spilled.discard(key)
+        metrics.MEMORY_STORAGE_PAGING_TOTAL.labels("in").inc()
+        self._store(r)
+        return r
+
+    def _peek(self, key: str) -> BellResource:
+        """Return resource on memory or in spill file without paging in."""
+        r = memory_storage_resource.get(key)
+        if r is None:
+            r = BellResource.from_dict(json.loads(self._spill[key]))
+        return r
+
+    def _count(self) -> None:
+        metrics.MEMORY_STORAGE_RESOURCES.labels("memory").set(len(memory_storage_resource))
+        metrics.MEMORY_STORAGE_RESOURCES.labels("spill").set(len(memory_storage_spilled))
+
+    def _journal_path(self) -> pathlib.Path:
+        return self._snapshot.with_name(self._snapshot.name + ".log")
+
+    def _write_journal(self, obj: dict) -> None:
+        """Append change to the change log."""
+        if self._journal:
+            self._journal.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+    def _apply(self, obj: dict) -> None:
+        """Apply change in snapshot or change log."""
+        if obj["op"] == "put":
+            r = BellResource.from_dict(obj["resource"])
+            if r.uuid in memory_storage_spilled:
+                self._spill[r.uuid] = json.dumps(obj["resource"], separators=(",", ":"))
+                self._changed(r.uuid, r)
+            elif r.uuid in memory_storage_resource:
+                memory_storage_resource[r.uuid] = r
+                self._changed(r.uuid, r)
+            else:
+                self._insert(r)
+        elif obj["op"] == "delete":
+            key = obj["uuid"]
+            r = memory_storage_resource.pop(key, None)
+            if r:
+                del memory_storage_lock[key]
+            elif key in memory_storage_spilled:
+                r = self._peek(key)
+                memory_storage_spilled.discard(key)
+            if r:
+                memory_storage_index.pop(bisect_left(memory_storage_index,
+                                                     (r.created_at.timestamp(), key)))
+                self._changed(key, None)
+        elif obj["op"] == "put_schedule":
+            schedule = RingSchedule.from_dict(obj["schedule"])
+            memory_storage_schedule[schedule.uuid] = schedule
+        elif obj["op"] == "delete_schedule":
+            memory_storage_schedule.pop(obj["uuid"], None)
+
+    def restore(self) -> None:
+        """Load records from the snapshot file and replay the change log."""
+        start = time.perf_counter()
+        count = 0
+        for path in (self._snapshot, self._journal_path()):
+            if not path.is_file():
+                continue
+            with open(path) as f:
+                for i, line in enumerate(f):
+                    try:
+                        obj = json.loads(line)
+                        if "op" in obj:
+                            self._apply(obj)
+                            count += 1
+                        elif obj.get("version") != self.SNAPSHOT_VERSION:
+                            msg = "Snapshot version {} is not supported."
+                            raise ValueError(msg.format(obj.get("version")))
+                    except Exception as ex:
+                        msg = "Error in restoring '{}' at line {} ({})."
+                        logging.error(msg.format(path, i + 1, ex))
+                        break
+        msg = "{} records were restored from '{}' in {:.3f} sec."
+        logging.info(msg.format(count, self._snapshot, time.perf_counter() - start))
+
+    def _fail_interrupted(self) -> None:
+        """Fail restored resources which were ringing when the server stopped."""
+        for _, key in list(memory_storage_index):
+            r = self._peek(key)
+            if not r.is_using():
+                continue
+            r = copy.deepcopy(r)
+            r.fail()
+            self._compare_and_set(r)
+            logging.warning("Resource '{}' was ringing when the server stopped.".format(key))
+
+    def save_snapshot(self) -> None:
+        """Write all records to the snapshot file and truncate the change log."""
+        if not self._snapshot or self._journal is None:
+            return
+        tmp = self._snapshot.with_name(self._snapshot.name + ".tmp")
+        try:
+            with open(tmp, "w") as f:
+                f.write(json.dumps({"version": self.SNAPSHOT_VERSION,
+                                    "created_at": datetime.now().isoformat()}) + "\n")
+                for _, key in memory_storage_index:
+                    f.write(json.dumps({"op": "put", "resource": self._peek(key).to_dict()},
+                                       separators=(",", ":")) + "\n")
+                for x in memory_storage_schedule.values():
+                    f.write(json.dumps({"op": "put_schedule", "schedule": x.to_dict()},
+                                       separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._snapshot)
+        except Exception as ex:
+            logging.error("Error in saving snapshot '{}' ({}).".format(self._snapshot, ex))
+            return
+        self._journal.close()
+        self._journal = open(self._journal_path(), "w", buffering=1)
+
+    def close(self) -> None:
+        """Save snapshot and close the change log (and spill file)."""
+        if self._snapshot_callback is not None:
+            self._snapshot_callback.stop()
+            self._snapshot_callback = None
+        if self._journal:
+            self.save_snapshot()
+            self._journal.close()
+            self._journal = None
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    @metrics.observe_storage("get_resource_context")
     async def get_resource_context(self, key: str) -> MemoryContext:
         """Get resource from database and return the resource wrapped with MemoryContext."""
-        lock = memory_storage_lock.get(key)
-        if lock:
-            lock.acquire()
-            resource = memory_storage_resource.get(key)
-            if resource:
-                return MemoryContext(copy.deepcopy(resource), lock)
-            else:
-                lock.release()
-                return MemoryContext(None)
-        else:
-            return MemoryContext(None)
-
+        while True:
+            if self._load(key) is None:
+                return MemoryContext(None, self)
+            lock = memory_storage_lock[key]
+            start = time.perf_counter()
+            await lock.acquire()
+            metrics.STORAGE_LOCK_WAIT_SECONDS.labels(type(self).__name__).observe(
+                time.perf_counter() - start)
+            if memory_storage_lock.get(key) is lock:
+                break
+            lock.release()
+        with tracing.span("deepcopy"):
+            resource = copy.deepcopy(memory_storage_resource[key])
+        return MemoryContext(resource, self, lock)
+
+    @metrics.observe_storage("get_resource")
+    async def get_resource(self, key: str) -> Optional[BellResource]:
+        """Get snapshot of resource from database without lock."""
+        resource = self._load(key)
+        return copy.deepcopy(resource) if resource else None
+
+    def _compare_and_set(self, obj: BellResource) -> None:
+        current = self._load(obj.uuid)
+        if current is None:
+            raise KeyError(obj.uuid)
+        if current.version != obj.version:
+            raise VersionConflictError(copy.deepcopy(current))
+        obj.version += 1
+        resource = copy.deepcopy(obj)
+        self._store(resource, cold=resource.is_used())
+        self._write_journal({"op": "put", "resource": resource.to_dict()})
+        self._changed(obj.uuid, resource)
+
+    @metrics.observe_storage("update_resource")
+    async def update_resource(self, obj: BellResource) -> None:
+        """Update resource record if its version is not changed (see `BaseStorage`)."""
+        obj.clear_validation_cache()
+        self._compare_and_set(obj)
+
+    @metrics.observe_storage("get_all_resources")
     def get_all_resources(self,
                           cond: Optional[List]=None,
                           start_key: Optional[str]=None,
                           limit: Optional[int]=None) -> List[BellResource]:
-        """Get resource list from database."""
-        if start_key is not None and start_key not in memory_storage_resource:
+        """Get resource list from database (see `BaseStorage.get_all_resources`)."""
+        if start_key is None:
+            end = len(memory_storage_index)
+        elif (start_key not in memory_storage_resource and
+              start_key not in memory_storage_spilled):
             raise KeyError
-        return list(reversed([memory_storage_resource[x] for x in memory_storage_resource.keys()
-                              if start_key is None or memory_storage_resource[x].created_at >=
-                              memory_storage_resource[start_key].created_at][:limit]))
-
+        else:
+            start = self._peek(start_key)
+            end = bisect_left(memory_storage_index,
+                              (start.created_at.timestamp(), start_key)) + 1
+        begin = max(0, end - limit) if limit else 0
+        return [self._peek(x) for _, x in reversed(memory_storage_index[begin:end])]
+
+    @metrics.observe_storage("get_resources")
+    def get_resources(self, keys: Sequence[str]) -> List[BellResource]:
+        """Get resources of keys (see `BaseStorage.get_resources`)."""
+        return [self._peek(x) for x in keys
+                if x in memory_storage_resource or x in memory_storage_spilled]
+
+    @metrics.observe_storage("create_resource")
     async def create_resource(self, obj: BellResource) -> None:
         """Create resource record."""
-        if obj.uuid in memory_storage_resource:
+        if obj.uuid in memory_storage_resource or obj.uuid in memory_storage_spilled:
             raise ValueError
         else:
-            memory_storage_resource[obj.uuid] = copy.deepcopy(obj)
-            memory_storage_lock[obj.uuid] = Lock()
+            self._insert(copy.deepcopy(obj))
 
+    @metrics.observe_storage("delete_resource")
     async def delete_resource(self, key: str) -> BellResource:
         """Delete resource record."""
-        if key not in memory_storage_resource:
-            raise KeyError
-        else:
-            r = copy.deepcopy(memory_storage_resource[key])
-            memory_storage_lock[key].acquire()
-            del memory_storage_resource[key]
-            memory_storage_lock[key].release()
-            return r
-
-
-class RedisContext(BaseContext):
-    """With-statement context which processes RedisStorage with specified resource."""
-
-    def __init__(self, resource: BellResource,
-                 storage: RedisStorage, lock: Optional[str]=None) -> None:
-        """Initialize with BellResource, RedisStorage and lock key."""
-        super().__init__(resource)
-        self._storage = storage
-        self._lock = lock
-
-    async def __aenter__(self):
-        """Enter context with resource."""
-        return self
-
-    async def __aexit__(self, ex_type, ex_value, trace):
-        """Write back resource and release lock."""
-        ex = ex_type or ex_value or trace
-        if self._lock:
-            if not ex:
-                self._storage.redis.set(self.resource.uuid, json.dumps(self.resource.to_dict()))
-            self._storage.redis.delete(self._lock)
-        return not ex
-
-
-class RedisStorage(BaseStorage):
-    """Database implementation with Redis."""
-    LOCK_LIMIT = 10
-    SLEEP_TIME = 0.1
-    FETCH_COUNT = 100
-
-    def __init__(self, addr: DataBaseAddress) -> None:
-        """Initialize with initial resource list."""
-        super().__init__(addr)
-        self.redis = redis.StrictRedis(host=addr.host, port=addr.port, db=addr.db)
-
-    async def get_resource_context(self, key: str) -> RedisContext:
-        """Get resource from database and return the resource wrapped with RedisContext."""
-        lock = "lock." + key
-        while self.redis.setnx(lock, datetime.now().timestamp()) == 0:
-            await asyncio.sleep(self.SLEEP_TIME)
-        self.redis.expire(lock, self.LOCK_LIMIT)
-        resource = self.redis.get(key)
-        if resource:
-            return RedisContext(BellResource.from_dict(json.loads(resource)), self, lock)
+        while True:
+            if key in memory_storage_spilled:
+                r = self._peek(key)
+                memory_storage_spilled.discard(key)
+                break
+            lock = memory_storage_lock.get(key)
+            if lock is None:
+                raise KeyError
+            async with lock:
+                if memory_storage_lock.get(key) is lock:
+                    r = memory_storage_resource.pop(key)
+                    del memory_storage_lock[key]
+                    break
+        self._count()
+        memory_storage_index.pop(bisect_left(memory_storage_index,
+                                             (r.created_at.timestamp(), key)))
+        self._write_journal({"op": "delete", "uuid": key})
+        self._changed(key, None)
+        return r
+
+    @metrics.observe_storage("get_all_schedules")
+    def get_all_schedules(self) -> List[RingSchedule]:
+        """Get schedule list from database in order of fire time."""
+        return list(sorted(memory_storage_schedule.values(), key=lambda x: x.timestamp()))
+
+    @metrics.observe_storage("create_schedule")
+    async def create_schedule(self, obj: RingSchedule) -> None:
+        """Create schedule record."""
+        if obj.uuid in memory_storage_schedule:
+            raise ValueError
         else:
-            self.redis.delete(lock)
-            return RedisContext(None, self)
+            memory_storage_schedule[obj.uuid] = copy.deepcopy(obj)
+            self._write_journal({"op": "put_schedule", "schedule": obj.to_dict()})
 
-    def get_all_resources(self,
-                          cond: Optional[List]=None,
-                          start_key: Optional[str]=None,
-                          limit: Optional[int]=None) -> List[BellResource]:
-        """Get resource list from database."""
-        start_item = self.redis.get(start_key) if start_key else None
-        if start_key and not start_item:
+    @metrics.observe_storage("delete_schedule")
+    async def delete_schedule(self, key: str) -> RingSchedule:
+        """Delete schedule record."""
+        if key not in memory_storage_schedule:
             raise KeyError
-        keys = list(sorted(filter(lambda x: not x.startswith(b"lock."), self.redis.keys())))
-        result = list()
-        for x in range(int(len(keys) / self.FETCH_COUNT) + 1):
-            with self.redis.pipeline() as pipe:
-                for key in keys[(x * self.FETCH_COUNT):((x + 1) * self.FETCH_COUNT)]:
-                    pipe.get(key)
-                p = pipe.execute()
-            for y in p:
-                buf = BellResource.from_dict(json.loads(y))
-                if not start_key or buf.created_at >= start_item.created_at:
-                    result.append(buf)
-                if limit and len(result) >= limit:
-                    return list(sorted(result, key=lambda x: x.created_at, reverse=True))
-        return list(sorted(result, key=lambda x: x.created_at, reverse=True))
-
-    async def create_resource(self, obj: BellResource) -> None:
-        """Create resource record."""
-        lock = "lock." + obj.uuid
-        while self.redis.setnx(lock, datetime.now().timestamp()) == 0:
-            await asyncio.sleep(self.SLEEP_TIME)
-        self.redis.expire(lock, self.LOCK_LIMIT)
-        setnx = self.redis.setnx(obj.uuid, json.dumps(obj.to_dict()))
-        self.redis.delete(lock)
-        if not setnx:
-            raise ValueError
-
-    async def delete_resource(self, key: str) -> BellResource:
-        """Delete resource record."""
-        lock = "lock." + key
-        while self.redis.setnx(lock, datetime.now().timestamp()) == 0:
-            await asyncio.sleep(self.SLEEP_TIME)
-        self.redis.expire(lock, self.LOCK_LIMIT)
-        resource = self.redis.get(key)
-        if resource:
-            self.redis.delete(key)
-            self.redis.delete(lock)
-            return BellResource.from_dict(json.loads(resource))
         else:
-            self.redis.delete(lock)
-            raise KeyError
+            self._write_journal({"op": "delete_schedule", "uuid": key})
+            return memory_storage_schedule.pop(key)
+
+    @metrics.observe_storage("append_event")
+    async def append_event(self, obj: RingEvent) -> None:
+        """Append ring event to history (and drop the oldest event if it is full)."""
+        if self._max_events <= 0:
+            return
+        while len(memory_storage_event) >= self._max_events:
+            _, _, oldest = memory_storage_event.popleft()
+            index = memory_storage_event_index[oldest.token]
+            index.popleft()
+            if not index:
+                del memory_storage_event_index[oldest.token]
+        seq = memory_storage_event[-1][1] + 1 if memory_storage_event else 0
+        memory_storage_event.append((obj.timestamp(), seq, copy.deepcopy(obj)))
+        memory_storage_event_index.setdefault(obj.token, deque()).append((obj.timestamp(), seq))
+
+    @metrics.observe_storage("get_events")
+    def get_events(self, token: Optional[str]=None,
+                   since: Optional[datetime]=None, until: Optional[datetime]=None,
+                   limit: Optional[int]=None) -> List[RingEvent]:
+        """Get ring events (see `BaseStorage.get_events`)."""
+        keys: Sequence[Tuple] = (memory_storage_event if token is None
+                                 else memory_storage_event_index.get(token, ()))
+        begin = bisect_left(keys, (since.timestamp(), )) if since else 0
+        end = bisect_right(keys, (until.timestamp(), float("inf"))) if until else len(keys)
+        if limit:
+            begin = max(begin, end - limit)
+        if begin >= end:
+            return list()
+        first = memory_storage_event[0][1]
+        return [memory_storage_event[keys[x][1] - first][2]
+                for x in reversed(range(begin, end))]
+
+    @metrics.observe_storage("reserve_response")
+    async def reserve_response(self, key: str, expire: int) -> Optional[dict]:
+        """Reserve idempotency key (see `BaseStorage.reserve_response`)."""
+        now = time.monotonic()
+        while memory_storage_response:
+            oldest = next(iter(memory_storage_response.values()))
+            if oldest[0] > now and len(memory_storage_response) < self._max_responses:
+                break
+            memory_storage_response.popitem(last=False)
+        item = memory_storage_response.get(key)
+        if item and item[0] > now:
+            return copy.deepcopy(item[1])
+        memory_storage_response[key] = (now + expire, dict())
+        memory_storage_response.move_to_end(key)
+        return None
+
+    @metrics.observe_storage("store_response")
+    async def store_response(self, key: str, response: dict, expire: int) -> None:
+        """Store response with reserved idempotency key."""
+        memory_storage_response[key] = (time.monotonic() + expire, copy.deepcopy(response))
+        memory_storage_response.move_to_end(key)
+
+    @metrics.observe_storage("release_response")
+    async def release_response(self, key: str) -> None:
+        """Release reserved idempotency key without storing response."""
+        memory_storage_response.pop(key, None)
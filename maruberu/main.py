@@ -2,20 +2,33 @@
 # -*- coding: utf-8 -*-
 """Main module of maruberu."""
 
+import asyncio
 import crypt
 import logging
+import os
 import pathlib
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Optional
 
 import pytz
 from tornado import httpserver
 from tornado import ioloop
+from tornado import netutil
+from tornado import template
 from tornado import web
 from tornado.options import define
 from tornado.options import options
 
-from .env import get_env
-from .handler import AdminLoginHandler, AdminLogoutHandler, AdminTokenHandler
-from .handler import IndexHandler, ResourceHandler
+from . import metrics
+from . import tracing
+from .env import get_env, is_shared_env
+from .handler import AdminHistoryHandler, AdminLoginHandler, AdminLogoutHandler
+from .handler import AdminStatsHandler, AdminTokenHandler, AdminTraceHandler
+from .handler import IndexHandler, MetricsHandler, ResourceHandler
 
 
 define("conf", default="conf/server.conf", type=str)
@@ -25,59 +38,317 @@ define("host", default="localhost", type=str)
 define("port", default=8000, type=int)
 define("cookie_secret", default="secret", type=str)
 define("ring_command", default=":/bin/ring", type=str)
+define("ring_pattern_max_milliseconds", default=10000, type=int)
+define("ring_timeout_grace", default=5.0, type=float)
+define("ring_degraded_cooldown", default=60.0, type=float)
+define("coalesce_window", default=5.0, type=float)
+define("ring_queue_limit_admin", default=3, type=int)
+define("ring_queue_limit_api", default=1, type=int)
+define("ring_queue_limit_public", default=0, type=int)
+define("ring_priority_aging", default=10.0, type=float)
+define("ring_history_size", default=10000, type=int)
+define("ring_history_display", default=20, type=int)
+define("expiring_soon", default=86400, type=int)
+define("resource_table_rebuild_interval", default=0, type=int)
+define("webhook_urls", default="", type=str)
+define("webhook_queue_size", default=1000, type=int)
+define("webhook_batch_size", default=50, type=int)
+define("webhook_batch_interval", default=1.0, type=float)
+define("webhook_max_retries", default=5, type=int)
+define("webhook_retry_delay", default=1.0, type=float)
+define("webhook_timeout", default=10.0, type=float)
+define("webhook_max_clients", default=10, type=int)
+define("webhook_dead_letter", default="", type=str)
+define("token_filter", default=False, type=bool)
+define("token_filter_capacity", default=1000000, type=int)
+define("token_filter_error_rate", default=0.001, type=float)
+define("token_filter_rebuild_interval", default=3600, type=int)
+define("token_filter_sync_interval", default=1.0, type=float)
 define("admin_username", default="admin", type=str)
 define("admin_password", default="password", type=str)
 define("admin_password_hashed", default="", type=str)
 define("database", default="localhost:6379/0", type=str)
 define("env", default="ON_MEMORY", type=str)
+define("database_replicas", default="", type=str)
+define("database_replica_max_lag", default=0, type=int)
+define("database_replica_check_interval", default=5, type=int)
+define("idempotency_expire", default=86400, type=int)
+define("idempotency_reserve_expire", default=300, type=int)
+define("idempotency_max_keys", default=10000, type=int)
+define("memory_snapshot", default="", type=str)
+define("memory_snapshot_interval", default=300, type=int)
+define("memory_max_resources", default=0, type=int)
+define("memory_spill_file", default="", type=str)
+define("schedule_misfire", default="FIRE", type=str)
+define("schedule_misfire_grace", default=300, type=int)
+define("metrics", default=True, type=bool)
+define("trace", default="off", type=str)
+define("trace_file", default="trace.log", type=str)
+define("trace_sample_rate", default=0.01, type=float)
+define("trace_profile_interval", default=0, type=int)
+define("trace_profile_duration", default=1, type=int)
+define("startup_target", default=1.0, type=float)
+define("shutdown_timeout", default=30.0, type=float)
+define("listen_fds", default="", type=str)
+define("handoff_pid", default=0, type=int)
 
+TEMPLATE_PATH = pathlib.Path(__file__).parent / "templates"
 
-def main() -> None:
-    """Start maruberu server."""
+
+class StartupTimer(object):
+    """Measure startup phases until the first request is served."""
+
+    def __init__(self) -> None:
+        """Start timer."""
+        self.start = time.perf_counter()
+        self._last = self.start
+        self._done = False
+
+    def lap(self, phase: str) -> None:
+        """Record time from the last phase."""
+        now = time.perf_counter()
+        metrics.STARTUP_SECONDS.labels(phase).set(now - self._last)
+        logging.debug("Startup phase '{}' took {:.3f} sec.".format(phase, now - self._last))
+        self._last = now
+
+    def first_request(self) -> None:
+        """Record time to the first served request (only once)."""
+        if self._done:
+            return
+        self._done = True
+        self.lap("first_request")
+        total = self._last - self.start
+        metrics.STARTUP_SECONDS.labels("total").set(total)
+        if total > options.startup_target:
+            msg = "Startup to first request took {:.3f} sec (target: {:.3f} sec)."
+            logging.warning(msg.format(total, options.startup_target))
+        else:
+            logging.info("Startup to first request took {:.3f} sec.".format(total))
+
+
+def load_options(startup_timer: Optional[StartupTimer]=None, final: bool=True) -> None:
+    """Parse command line and conf (command line takes precedence), and check options."""
     options.parse_command_line(final=False)
     if pathlib.Path(options.conf).is_file():
         options.parse_config_file(options.conf, final=False)
-        options.parse_command_line()
+        options.parse_command_line(final=final)
     else:
-        options.parse_command_line()
+        options.parse_command_line(final=final)
         logging.warning("conf '{}' is not found.".format(options.conf))
+    if startup_timer:
+        startup_timer.lap("options")
     cwd = pathlib.Path(__file__).resolve().parent
     if options.ring_command[:2] == ":/":
         options.ring_command = str(cwd / options.ring_command[2:])
     if options.admin_password_hashed == "":
         options.admin_password_hashed = crypt.crypt(options.admin_password)
+    if startup_timer:
+        startup_timer.lap("password_hash")
     try:
         pytz.timezone(options.timezone)
     except pytz.exceptions.UnknownTimeZoneError:
         logging.warning("Timezone '{}' is not found.\
  'Asia/Tokyo' will be used.".format(options.timezone))
         options.timezone = "Asia/Tokyo"
+    if options.schedule_misfire not in ("FIRE", "SKIP"):
+        logging.warning("Misfire policy '{}' is not found.\
+ 'FIRE' will be used.".format(options.schedule_misfire))
+        options.schedule_misfire = "FIRE"
+    try:
+        tracing.set_mode(options.trace)
+    except ValueError as ex:
+        logging.warning("{} ('off' will be used).".format(ex))
 
+
+def load_templates(loader: template.Loader) -> None:
+    """Clear cache of loader and compile all templates."""
+    loader.reset()
+    for x in TEMPLATE_PATH.glob("*.html"):
+        loader.load(x.name)
+
+
+def make_app(env: dict, startup_timer: Optional[StartupTimer]=None) -> web.Application:
+    """Create application which handles requests with env variables.
+
+    Templates are compiled here instead of on the first request.
+    """
+    loader = template.Loader(str(TEMPLATE_PATH), autoescape="xhtml_escape")
+    load_templates(loader)
     settings = {
         "xsrf_cookies": True,
         "cookie_secret": options.cookie_secret,
         "static_path": pathlib.Path(__file__).parent / "static",
-        "template_path": pathlib.Path(__file__).parent / "templates",
+        "template_path": TEMPLATE_PATH,
+        "template_loader": loader,
+        "startup_timer": startup_timer,
         "login_url": "/admin/login/",
         "autoescape": "xhtml_escape",
         "debug": options.debug,
     }
-    env = get_env(options.env)
-    app = web.Application([
+    handlers = [
         (r"/", IndexHandler, env),
         (r"/resource/([0-9a-f-]+)?/?", ResourceHandler, env),
         (r"/admin/?", AdminTokenHandler, env),
         (r"/admin/login/?", AdminLoginHandler, env),
         (r"/admin/logout/?", AdminLogoutHandler, env),
+        (r"/admin/trace/?", AdminTraceHandler, env),
+        (r"/admin/history/?", AdminHistoryHandler, env),
+        (r"/admin/stats/?", AdminStatsHandler, env),
         (r"/static/(.*)", web.StaticFileHandler),
-    ], **settings)
-    server = httpserver.HTTPServer(app)
+    ]
+    if options.metrics:
+        handlers.append((r"/metrics", MetricsHandler, env))
+    return web.Application(handlers, **settings)
 
-    server.listen(options.port)
-    try:
-        ioloop.IOLoop.current().start()
-    except KeyboardInterrupt:
-        ioloop.IOLoop.current().add_callback(get_env("ON_MEMORY")["bell"]._ring_queue.put, None)
+
+class Server(object):
+    """HTTP server controlled by signals.
+
+    * SIGTERM/SIGINT: stop accepting, finish accepted rings and webhooks (or fail them
+      after `shutdown_timeout` seconds), flush database and stop IOLoop.
+    * SIGHUP: reload conf and templates. Options used only on startup (port, env,
+      database, ...) are applied by SIGUSR2.
+    * SIGUSR2: start new process with the listening sockets, which sends SIGTERM to this
+      process when it is ready. The new process is a child of this process, so it is not
+      supported as PID 1 (in a container) or under a service manager which tracks this
+      process (e.g. systemd), because the new process is killed when this process exits.
+    """
+
+    HANDOFF_POLL = 0.1
+
+    def __init__(self, app: web.Application, env: dict,
+                 sockets: List[socket.socket]) -> None:
+        """Initialize with application, env variables and listening sockets."""
+        self.app = app
+        self.env = env
+        self.sockets = sockets
+        self.server = httpserver.HTTPServer(app)
+        self._closing = False
+
+    @staticmethod
+    def bind_sockets() -> List[socket.socket]:
+        """Return sockets inherited by `listen_fds` or new sockets listening on `port`."""
+        if not options.listen_fds:
+            return netutil.bind_sockets(options.port)
+        sockets = [socket.socket(fileno=int(x)) for x in options.listen_fds.split(",")]
+        for x in sockets:
+            x.setblocking(False)
+        return sockets
+
+    def start(self) -> None:
+        """Start accepting and handling signals."""
+        self.server.add_sockets(self.sockets)
+        loop = ioloop.IOLoop.current().asyncio_loop
+        for x in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(x, ioloop.IOLoop.current().add_callback, self.shutdown)
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+        loop.add_signal_handler(signal.SIGUSR2, self.handoff)
+
+    async def shutdown(self) -> None:
+        """Stop accepting, drain bell and webhooks, flush database and stop IOLoop."""
+        if self._closing:
+            logging.warning("Server is already shutting down.")
+            return
+        self._closing = True
+        logging.info("Shutting down (waiting for rings at most {} sec).".format(
+            options.shutdown_timeout))
+        try:
+            self.server.stop()
+            self.env["scheduler"].stop()
+            await self.env["bell"].close(options.shutdown_timeout)
+            await self.env["webhook"].close(options.shutdown_timeout)
+            await self.server.close_all_connections()
+        except Exception as ex:
+            logging.error("Error in shutting down ({}).".format(ex))
+        finally:
+            self.env["database"].close()
+            ioloop.IOLoop.current().stop()
+
+    def reload(self) -> None:
+        """Reload conf and templates (keep all options as they were on error)."""
+        before = {k: v for k, v in options.items()}
+        try:
+            options.admin_password_hashed = ""
+            load_options(final=False)
+            load_templates(self.app.settings["template_loader"])
+        except Exception as ex:
+            for k, v in before.items():
+                setattr(options, k, v)
+            logging.error("Error in reloading ({}).".format(ex))
+            return
+        self.app.settings["cookie_secret"] = options.cookie_secret
+        changed = sorted(k for k, v in options.items() if before.get(k) != v and
+                         k != "admin_password_hashed")
+        logging.info("Reloaded conf and templates (changed: {}).".format(
+            ", ".join(changed) or "none"))
+
+    def handoff(self) -> None:
+        """Start new process which takes over the listening sockets."""
+        if self._closing:
+            return
+        if os.getpid() == 1:
+            logging.error("Handoff is not supported as PID 1 (restart the container instead).")
+            return
+        if not self.env["database"].SHARED and not options.memory_snapshot:
+            logging.error("Handoff needs memory_snapshot to take over tokens on memory.")
+            return
+        fds = [x.fileno() for x in self.sockets]
+        args = [x for x in sys.argv[1:]
+                if not x.startswith(("--listen_fds=", "--handoff_pid="))]
+        args.append("--listen_fds={}".format(",".join(str(x) for x in fds)))
+        args.append("--handoff_pid={}".format(os.getpid()))
+        try:
+            p = subprocess.Popen([sys.executable, "-m", "maruberu.main", *args], pass_fds=fds)
+        except Exception as ex:
+            logging.error("Error in starting new process ({}).".format(ex))
+            return
+        logging.info("Started new process {} to take over the server.".format(p.pid))
+
+    @classmethod
+    def release_parent(cls, wait: bool) -> None:
+        """Make the process which started this process (by `handoff`) shut down.
+
+        Wait for it to exit if `wait` is True.
+        """
+        os.kill(options.handoff_pid, signal.SIGTERM)
+        if wait:
+            logging.info("Waiting for process {} to exit.".format(options.handoff_pid))
+            while os.getppid() == options.handoff_pid:
+                time.sleep(cls.HANDOFF_POLL)
+
+    @classmethod
+    async def wait_for_parent(cls) -> None:
+        """Wait for the process which started this process to exit."""
+        while os.getppid() == options.handoff_pid:
+            await asyncio.sleep(cls.HANDOFF_POLL)
+        logging.info("Process {} exited.".format(options.handoff_pid))
+
+
+def main() -> None:
+    """Start maruberu server.
+
+    On handoff, storage which cannot be shared is loaded after the old process exited
+    (connections wait in the listening socket meanwhile). Otherwise the new process starts
+    accepting at once, and rings after the old process exited.
+    """
+    timer = StartupTimer()
+    load_options(timer)
+    sockets = Server.bind_sockets()
+    shared = is_shared_env(options.env)
+    if options.handoff_pid and not shared:
+        Server.release_parent(wait=True)
+
+    env = get_env(options.env)
+    timer.lap("env")
+    app = make_app(env, timer)
+    timer.lap("templates")
+    server = Server(app, env, sockets)
+    server.start()
+    timer.lap("listen")
+    if options.handoff_pid and shared:
+        env["bell"].hold(Server.wait_for_parent())
+        Server.release_parent(wait=False)
+    ioloop.IOLoop.current().start()
 
 
 if __name__ == "__main__":
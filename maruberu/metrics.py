@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Metrics module of maruberu.
+
+Metrics are updated only from the IOLoop thread, so counters and histograms are plain
+attributes without locks. Children for each label set are created once and cached.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+import functools
+import inspect
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from . import tracing
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RING_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+
+    __slots__ = ("value", )
+
+    def __init__(self) -> None:
+        """Initialize with zero."""
+        self.value = 0
+
+    def inc(self, amount: float=1) -> None:
+        """Increase value."""
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        """Return lines in Prometheus text format."""
+        return ["{}{} {}".format(name, labels, self.value)]
+
+
+class Gauge(Counter):
+    """Value which can go up and down."""
+
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        """Set value."""
+        self.value = value
+
+    def dec(self, amount: float=1) -> None:
+        """Decrease value."""
+        self.value -= amount
+
+
+class Histogram(object):
+    """Distribution of values in fixed buckets."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        """Initialize with upper bounds of buckets."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Add value to the bucket."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        """Return lines in Prometheus text format."""
+        lines = list()
+        prefix = labels[:-1] + "," if labels else "{"
+        acc = 0
+        for bound, count in zip([*self.buckets, "+Inf"], self.counts):
+            acc += count
+            lines.append("{}_bucket{}le=\"{}\"}} {}".format(name, prefix, bound, acc))
+        lines.append("{}_sum{} {}".format(name, labels, self.sum))
+        lines.append("{}_count{} {}".format(name, labels, self.count))
+        return lines
+
+
+class MetricFamily(object):
+    """Metrics with the same name and different labels."""
+
+    def __init__(self, name: str, documentation: str, kind: str,
+                 labelnames: Sequence[str]=(), factory: Callable=Counter) -> None:
+        """Initialize with name, help text, type and label names."""
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children: Dict[Tuple, object] = dict()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Return (and create if needed) the metric for label values."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    def expose(self) -> List[str]:
+        """Return lines in Prometheus text format."""
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for values, child in sorted(self._children.items(), key=lambda x: str(x[0])):
+            labels = ",".join("{}=\"{}\"".format(k, str(v).replace("\"", "\\\""))
+                              for k, v in zip(self.labelnames, values))
+            lines.extend(child.samples(self.name, "{" + labels + "}" if labels else ""))
+        return lines
+
+
+REGISTRY: List[MetricFamily] = list()
+
+HTTP_REQUEST_SECONDS = MetricFamily(
+    "maruberu_http_request_seconds", "HTTP request latency.", "histogram",
+    ("handler", "method", "status"), lambda: Histogram(LATENCY_BUCKETS))
+STORAGE_LOCK_WAIT_SECONDS = MetricFamily(
+    "maruberu_storage_lock_wait_seconds", "Time to acquire resource lock.", "histogram",
+    ("backend", ), lambda: Histogram(LATENCY_BUCKETS))
+STORAGE_OPERATION_SECONDS = MetricFamily(
+    "maruberu_storage_operation_seconds", "Storage operation latency.", "histogram",
+    ("backend", "operation"), lambda: Histogram(LATENCY_BUCKETS))
+RING_QUEUE_DEPTH = MetricFamily(
+    "maruberu_ring_queue_depth", "Number of resources waiting for bell.", "gauge",
+    (), Gauge)
+RING_QUEUE_WAIT_SECONDS = MetricFamily(
+    "maruberu_ring_queue_wait_seconds", "Time from enqueue to start of ringing.", "histogram",
+    (), lambda: Histogram(LATENCY_BUCKETS))
+RING_EXECUTION_SECONDS = MetricFamily(
+    "maruberu_ring_execution_seconds", "Execution time of ring command.", "histogram",
+    (), lambda: Histogram(RING_BUCKETS))
+RING_RESULT_TOTAL = MetricFamily(
+    "maruberu_ring_result_total", "Number of rings by result.", "counter",
+    ("result", ))
+RING_SHED_TOTAL = MetricFamily(
+    "maruberu_ring_shed_total", "Number of rings refused because the queue was full.",
+    "counter", ("priority", ))
+REDIS_REPLICA_HEALTHY = MetricFamily(
+    "maruberu_redis_replica_healthy", "Whether Redis replica is used for reads.", "gauge",
+    ("replica", ), Gauge)
+TOKEN_FILTER_REJECTED_TOTAL = MetricFamily(
+    "maruberu_token_filter_rejected_total", "Number of unknown tokens rejected by filter.",
+    "counter", ())
+BELL_DEGRADED = MetricFamily(
+    "maruberu_bell_degraded", "Whether bell refuses rings after timeout or crash.", "gauge",
+    (), Gauge)
+MEMORY_STORAGE_RESOURCES = MetricFamily(
+    "maruberu_memory_storage_resources", "Number of resources on memory or in spill file.",
+    "gauge", ("location", ), Gauge)
+MEMORY_STORAGE_PAGING_TOTAL = MetricFamily(
+    "maruberu_memory_storage_paging_total", "Number of resources moved to or from spill file.",
+    "counter", ("direction", ))
+WEBHOOK_QUEUE_DEPTH = MetricFamily(
+    "maruberu_webhook_queue_depth", "Number of ring events waiting for webhook delivery.",
+    "gauge", (), Gauge)
+WEBHOOK_EVENTS_TOTAL = MetricFamily(
+    "maruberu_webhook_events_total", "Number of webhook events by result.", "counter",
+    ("result", ))
+STARTUP_SECONDS = MetricFamily(
+    "maruberu_startup_seconds", "Time of each startup phase.", "gauge",
+    ("phase", ), Gauge)
+
+
+def expose() -> str:
+    """Return all metrics in Prometheus text format."""
+    lines = list()
+    for x in REGISTRY:
+        lines.extend(x.expose())
+    return "\n".join(lines) + "\n"
+
+
+def observe_storage(operation: str) -> Callable:
+    """Decorate storage method to observe its latency and record its span."""
+    def decorator(f: Callable) -> Callable:
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def wrapper(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    with tracing.span(operation):
+                        return await f(self, *args, **kwargs)
+                finally:
+                    STORAGE_OPERATION_SECONDS.labels(type(self).__name__, operation).observe(
+                        time.perf_counter() - start)
+        else:
+            @functools.wraps(f)
+            def wrapper(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    with tracing.span(operation):
+                        return f(self, *args, **kwargs)
+                finally:
+                    STORAGE_OPERATION_SECONDS.labels(type(self).__name__, operation).observe(
+                        time.perf_counter() - start)
+        return wrapper
+    return decorator
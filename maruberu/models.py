@@ -8,7 +8,7 @@ from datetime import datetime
 from enum import Enum
 import logging
 import re
-from typing import Callable, List, Optional, Union
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple, Union
 import uuid
 
 import pytz
@@ -30,6 +30,19 @@ class BellResourceStatus(Enum):
     USED = 30
 
 
+class BellResourcePriority(Enum):
+    """Priority class of bell resource (smaller value rings first).
+
+    * ADMIN: issued by admin for urgent use
+    * API: used by bots
+    * PUBLIC: used by everyone
+    """
+
+    ADMIN = 0
+    API = 1
+    PUBLIC = 2
+
+
 class InvalidResourceOperationError(RuntimeError):
     """Base exception for BellResource."""
 
@@ -74,42 +87,86 @@ class ResourceBusyError(InvalidResourceOperationError):
 class ResourceForbiddenError(InvalidResourceOperationError):
     """The bell is not ready now. Ring later."""
 
-    def __init__(self) -> None:
-        """Initialize with detailed message."""
-        super().__init__("ベルを鳴らす準備ができていません。")
+    def __init__(self, reason: Optional[str]=None) -> None:
+        """Initialize with detailed message (and the reason)."""
+        super().__init__("ベルを鳴らす準備ができていません。" +
+                         ("（{}）".format(reason) if reason else ""))
+
+
+class VersionConflictError(RuntimeError):
+    """The resource was updated by others. Retry with the current resource."""
+
+    def __init__(self, resource: BellResource) -> None:
+        """Initialize with the current resource in database."""
+        super().__init__("'{}' was updated to version {}.".format(resource.uuid,
+                                                                resource.version))
+        self.resource = resource
 
 
 class BellResource(object):
-    """Resource of ringing bell with fixed time."""
+    """Resource of ringing bell with fixed time (or on/off pattern).
+
+    `pattern` is a list of on/off milliseconds which starts and ends with on, and
+    `milliseconds` of pattern resource is its total duration.
+
+    Requests to *coalesce* resource while it is ringing share the result of the ring.
+
+    Result of each ring is posted to `callback_url` (see `webhook.WebhookDispatcher`).
+
+    `priority` decides the order and admission of rings while the bell is busy
+    (see `infrastructure.MaruBell`). It is API for *api* resource and PUBLIC for others
+    if not specified.
+
+    `version` is increased every time the resource is written to database, and writes
+    with old version are rejected (see `BaseStorage.update_resource`).
+    """
 
     def __init__(self, milliseconds: int,
                  not_before: Optional[datetime], not_after: Optional[datetime],
                  sticky: bool=False,
                  api: bool=False,
+                 pattern: Optional[List[int]]=None,
+                 coalesce: bool=False,
+                 callback_url: Optional[str]=None,
+                 priority: Optional[BellResourcePriority]=None,
                  uuid: Union[str, Callable]=uuid.uuid4,
                  status: BellResourceStatus=BellResourceStatus.UNUSED,
                  failed_count: int=0,
                  created_at: Optional[datetime]=None,
-                 updated_at: Optional[datetime]=None) -> None:
+                 updated_at: Optional[datetime]=None,
+                 version: int=0) -> None:
         """Initialize with resource params."""
         if not_before and not_after and not_before > not_after:
             raise ValueError("Expected not_before < not_after,\
  but {}(not_before) > {}(not_after).".format(not_before, not_after))
+        if pattern and (len(pattern) % 2 == 0 or min(pattern) <= 0):
+            raise ValueError("Expected positive on/off milliseconds which ends with on,\
+ but {}(pattern).".format(pattern))
+        if callback_url and not re.match(r"https?://[^\s]+$", callback_url):
+            raise ValueError("Expected http(s) URL, but {}(callback_url).".format(callback_url))
         # on table
         self.uuid: str = str(uuid() if callable(uuid) else uuid)
         self.milliseconds: int = milliseconds
         self.not_before: Optional[datetime] = (pytz.timezone(options.timezone).localize(not_before)
-                                               if not_before else None)
+                                               if not_before and not_before.tzinfo is None
+                                               else not_before)
         self.not_after: Optional[datetime] = (pytz.timezone(options.timezone).localize(not_after)
-                                              if not_after else None)
+                                              if not_after and not_after.tzinfo is None
+                                              else not_after)
         self.sticky: bool = sticky
         self.api: bool = api
+        self.pattern: List[int] = list(pattern or [])
+        self.coalesce: bool = coalesce
+        self.callback_url: Optional[str] = callback_url or None
+        self.priority: BellResourcePriority = (priority or (BellResourcePriority.API if api else
+                                                            BellResourcePriority.PUBLIC))
         self._status: BellResourceStatus = status
         self._failed_count: int = failed_count
         self.created_at: datetime = (datetime.fromisoformat(created_at) if created_at else
                                      datetime.now(pytz.utc))
         self.updated_at: datetime = (datetime.fromisoformat(updated_at) if updated_at else
                                      datetime.now(pytz.utc))
+        self.version: int = version
         # not on table
         self._is_before_period: Optional[bool] = None
         self._is_after_period: Optional[bool] = None
@@ -123,11 +180,16 @@ class BellResource(object):
                    datetime.fromisoformat(buf["not_after"])
                    if buf["not_after"] else None,
                    bool(buf.get("sticky", False)), bool(buf.get("api", False)),
+                   [int(x) for x in buf.get("pattern") or []],
+                   bool(buf.get("coalesce", False)),
+                   buf.get("callback_url"),
+                   BellResourcePriority[buf["priority"]] if buf.get("priority") else None,
                    uuid=str(buf["uuid"]),
                    status=BellResourceStatus[buf["status"]],
                    failed_count=int(buf.get("failed_count", 0)),
                    created_at=buf["created_at"],
-                   updated_at=buf["updated_at"])
+                   updated_at=buf["updated_at"],
+                   version=int(buf.get("version", 0)))
 
     def to_dict(self) -> str:
         """Extract BellResource as dict."""
@@ -137,12 +199,33 @@ class BellResource(object):
                "not_after": self.not_after.isoformat() if self.not_after else None,
                "sticky": self.sticky,
                "api": self.api,
+               "pattern": self.pattern,
+               "coalesce": self.coalesce,
+               "callback_url": self.callback_url,
+               "priority": self.priority.name,
                "status": self._status.name,
                "failed_count": self._failed_count,
                "created_at": self.created_at.isoformat() if self.created_at else None,
-               "updated_at": self.updated_at.isoformat() if self.updated_at else None}
+               "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+               "version": self.version}
         return obj
 
+    @staticmethod
+    def parse_pattern(text: str) -> List[int]:
+        """Parse on/off milliseconds separated by comma and check its total duration."""
+        pattern = [int(x) for x in text.split(",") if x.strip()]
+        if len(pattern) % 2 == 0 or min(pattern) <= 0:
+            msg = "pattern must be positive on/off milliseconds which ends with on (actual: {})"
+            raise ValueError(msg.format(text))
+        if sum(pattern) > options.ring_pattern_max_milliseconds:
+            msg = "total of pattern must be <= {} (actual: {})"
+            raise ValueError(msg.format(options.ring_pattern_max_milliseconds, sum(pattern)))
+        return pattern
+
+    def get_sequence(self) -> List[int]:
+        """Return on/off milliseconds to ring bell."""
+        return self.pattern or [self.milliseconds]
+
     def _validate_period(self) -> None:
         """Check if it is within valid period.
 
@@ -194,6 +277,14 @@ class BellResource(object):
 
     def ring(self, bell: BaseBell) -> None:
         """Ring bell by this resource."""
+        self.prepare_ring(bell)
+        bell.ring(self)
+
+    def prepare_ring(self, bell: BaseBell) -> None:
+        """Check if bell can be rung by this resource and mark it in use (without ringing).
+
+        Call `bell.ring` after the resource is written, or `cancel` if it was failed.
+        """
         if not self.is_valid():
             if self.is_before_period():
                 raise ResourceBeforePeriodError
@@ -206,14 +297,22 @@ class BellResource(object):
         elif False:  # TODO forbid
             raise ResourceForbiddenError
         else:
-            bell.ring(self)
+            bell.check(self)
             self._status = BellResourceStatus.USING
 
+    def cancel(self) -> None:
+        """Callback method if resource could not ring bell after `prepare_ring`."""
+        if not self.is_using():
+            raise InvalidResourceOperationError
+        else:
+            self._status = BellResourceStatus.UNUSED
+
     def success(self) -> None:
         """Callback method if resource succeeded in ringing bell."""
         if not self.is_using():
             raise InvalidResourceOperationError
         else:
+            self.clear_validation_cache()
             self._failed_count = 0
             if self.sticky and self.is_within_period():
                 self._status = BellResourceStatus.UNUSED
@@ -225,6 +324,7 @@ class BellResource(object):
         if not self.is_using():
             raise InvalidResourceOperationError
         else:
+            self.clear_validation_cache()
             self._failed_count += 1
             if not self.is_within_period():
                 self._status = BellResourceStatus.USED
@@ -234,6 +334,77 @@ class BellResource(object):
                 logging.error("'{}' was failed {} times.".format(self.uuid, self._failed_count))
 
 
+class RingSchedule(object):
+    """Schedule of ringing bell by resource at fixed time."""
+
+    def __init__(self, token: str, fire_at: datetime,
+                 uuid: Union[str, Callable]=uuid.uuid4,
+                 created_at: Optional[datetime]=None) -> None:
+        """Initialize with schedule params."""
+        self.uuid: str = str(uuid() if callable(uuid) else uuid)
+        self.token: str = token
+        self.fire_at: datetime = (pytz.timezone(options.timezone).localize(fire_at)
+                                  if fire_at.tzinfo is None else fire_at)
+        self.created_at: datetime = (datetime.fromisoformat(created_at) if created_at else
+                                     datetime.now(pytz.utc))
+
+    @classmethod
+    def from_dict(cls, buf) -> RingSchedule:
+        """Get RingSchedule from dict."""
+        return cls(str(buf["token"]),
+                   datetime.fromisoformat(buf["fire_at"]),
+                   uuid=str(buf["uuid"]),
+                   created_at=buf["created_at"])
+
+    def to_dict(self) -> dict:
+        """Extract RingSchedule as dict."""
+        return {"uuid": self.uuid,
+                "token": self.token,
+                "fire_at": self.fire_at.isoformat(),
+                "created_at": self.created_at.isoformat() if self.created_at else None}
+
+    def timestamp(self) -> float:
+        """Return fire time in POSIX timestamp."""
+        return self.fire_at.timestamp()
+
+
+class RingEvent(object):
+    """History of ringing bell by resource."""
+
+    def __init__(self, token: str, enqueued_at: datetime, started_at: datetime,
+                 finished_at: datetime, result: str, returncode: Optional[int]) -> None:
+        """Initialize with event params (`returncode` is None if command was not run)."""
+        self.token: str = token
+        self.enqueued_at: datetime = enqueued_at
+        self.started_at: datetime = started_at
+        self.finished_at: datetime = finished_at
+        self.result: str = result
+        self.returncode: Optional[int] = returncode
+
+    @classmethod
+    def from_dict(cls, buf) -> RingEvent:
+        """Get RingEvent from dict."""
+        return cls(str(buf["token"]),
+                   datetime.fromisoformat(buf["enqueued_at"]),
+                   datetime.fromisoformat(buf["started_at"]),
+                   datetime.fromisoformat(buf["finished_at"]),
+                   str(buf["result"]),
+                   None if buf["returncode"] is None else int(buf["returncode"]))
+
+    def to_dict(self) -> dict:
+        """Extract RingEvent as dict."""
+        return {"token": self.token,
+                "enqueued_at": self.enqueued_at.isoformat(),
+                "started_at": self.started_at.isoformat(),
+                "finished_at": self.finished_at.isoformat(),
+                "result": self.result,
+                "returncode": self.returncode}
+
+    def timestamp(self) -> float:
+        """Return finish time in POSIX timestamp."""
+        return self.finished_at.timestamp()
+
+
 class DataBaseAddress(object):
     """Database address representation with host, port and dbname."""
 
@@ -252,6 +423,15 @@ class DataBaseAddress(object):
             msg = "{} is not in database address format (user:pass@)host:port/dbname"
             raise ValueError(msg.format(uri))
 
+    @classmethod
+    def parse_list(cls, uri: str) -> List[DataBaseAddress]:
+        """Parse addresses separated by comma."""
+        return [cls(x.strip()) for x in uri.split(",") if x.strip()]
+
+    def location(self) -> str:
+        """Return URI in format of `host:port/dbname` (without credentials)."""
+        return "{}:{}/{}".format(self.host, self.port, self.db)
+
     def __repr__(self):
         """Return URI in format of `(user:pass@)host:port/dbname` in repr(str)."""
         if self.username:
@@ -286,31 +466,175 @@ class BaseContext(object):
 
 
 class BaseStorage(object):
-    """Database implementation."""
+    """Database implementation.
+
+    Listeners are called with key and resource (None if deleted) when the resource is
+    changed through this storage.
+
+    `SHARED` storage can be used by other processes at the same time (see `main` for
+    handing over the server to a new process).
+    """
+
+    CAS_RETRY = 10
+    SHARED = False
 
     def __init__(self, addr: DataBaseAddress) -> None:
         """Initialize with database address."""
         self.addr = addr
+        self._listeners: List[Callable[[str, Optional[BellResource]], None]] = list()
+
+    def add_listener(self, listener: Callable[[str, Optional[BellResource]], None]) -> None:
+        """Add listener of changes of resources."""
+        self._listeners.append(listener)
+
+    def _changed(self, key: str, resource: Optional[BellResource]) -> None:
+        """Notify change of resource to listeners."""
+        for f in self._listeners:
+            try:
+                f(key, resource)
+            except Exception as ex:
+                logging.error("Error in notifying change of '{}' ({}).".format(key, ex))
+
+    @classmethod
+    def from_options(cls, addr: DataBaseAddress) -> BaseStorage:
+        """Create database with address and server options."""
+        return cls(addr)
 
     async def get_resource_context(self, key: str) -> BaseContext:
         """Get resource from database and return the resource wrapped with context."""
         raise NotImplementedError
 
+    async def get_resource(self, key: str) -> Optional[BellResource]:
+        """Get snapshot of resource from database without lock."""
+        c = await self.get_resource_context(key)
+        async with c:
+            return c.resource
+
     def get_all_resources(self,
                           cond: Optional[List]=None,
                           start_key: Optional[str]=None,
                           limit: Optional[int]=None) -> List[BellResource]:
-        """Get resource list from database."""
+        """Get resource list from database.
+
+        Resources are ordered by `created_at` (and `uuid` for tie) from newest.
+        The list starts at `start_key` (inclusive) if specified, and has `limit` resources
+        at most. Raise KeyError if `start_key` is not found.
+        """
         raise NotImplementedError
 
+    def get_resources(self, keys: Sequence[str]) -> List[BellResource]:
+        """Get resources of keys in the same order (keys not found are skipped).
+
+        This implementation scans all resources, so backends should override it.
+        """
+        wanted = set(keys)
+        found = {x.uuid: x for x in self.get_all_resources() if x.uuid in wanted}
+        return [found[x] for x in keys if x in found]
+
     async def create_resource(self, obj: BellResource) -> None:
         """Create resource record."""
         raise NotImplementedError
 
+    async def update_resource(self, obj: BellResource) -> None:
+        """Write resource record without lock if its version is not changed.
+
+        Increase `obj.version` if succeeded, raise VersionConflictError with the current
+        resource if the version was changed, and raise KeyError if it was deleted.
+        """
+        raise NotImplementedError
+
     async def delete_resource(self, key: str) -> BellResource:
         """Delete resource record."""
         raise NotImplementedError
 
+    async def ring_resource(self, resource: BellResource, bell: BaseBell
+                            ) -> Tuple[Optional[BellResource],
+                                       Optional[InvalidResourceOperationError]]:
+        """Mark resource in use by `update_resource` and pass it to bell.
+
+        Retry with the current resource if it was updated by others. Return the current
+        resource (None if it was deleted) and the reason if it was not rung.
+        """
+        for _ in range(self.CAS_RETRY):
+            try:
+                resource.prepare_ring(bell)
+            except InvalidResourceOperationError as ex:
+                return resource, ex
+            try:
+                await self.update_resource(resource)
+            except VersionConflictError as ex:
+                resource = ex.resource
+                continue
+            except KeyError:
+                return None, None
+            try:
+                bell.ring(resource)
+            except InvalidResourceOperationError as ex:
+                await self._cancel_ring(resource)
+                return resource, ex
+            return resource, None
+        return resource, ResourceBusyError()
+
+    async def _cancel_ring(self, resource: BellResource) -> None:
+        """Mark resource which was not passed to bell as unused again."""
+        for _ in range(self.CAS_RETRY):
+            try:
+                resource.cancel()
+                await self.update_resource(resource)
+            except VersionConflictError as ex:
+                resource = ex.resource
+                continue
+            except (InvalidResourceOperationError, KeyError):
+                pass
+            return
+        logging.error("Resource '{}' may be left in use.".format(resource.uuid))
+
+    def get_all_schedules(self) -> List[RingSchedule]:
+        """Get schedule list from database in order of fire time."""
+        raise NotImplementedError
+
+    async def create_schedule(self, obj: RingSchedule) -> None:
+        """Create schedule record."""
+        raise NotImplementedError
+
+    async def delete_schedule(self, key: str) -> RingSchedule:
+        """Delete schedule record."""
+        raise NotImplementedError
+
+    async def append_event(self, obj: RingEvent) -> None:
+        """Append ring event to history."""
+        raise NotImplementedError
+
+    def get_events(self, token: Optional[str]=None,
+                   since: Optional[datetime]=None, until: Optional[datetime]=None,
+                   limit: Optional[int]=None) -> List[RingEvent]:
+        """Get ring events (of token) from history.
+
+        Events finished in [since, until] are returned from the newest (at most `limit`).
+        """
+        raise NotImplementedError
+
+    async def reserve_response(self, key: str, expire: int) -> Optional[dict]:
+        """Reserve idempotency key, or return the response stored with the key.
+
+        Return None if the key is newly reserved for `expire` seconds (until its response
+        is stored or released), and return a dict without "code" if the key is reserved
+        but its response is not stored yet.
+        """
+        raise NotImplementedError
+
+    async def store_response(self, key: str, response: dict, expire: int) -> None:
+        """Store response with reserved idempotency key for `expire` seconds."""
+        raise NotImplementedError
+
+    async def release_response(self, key: str) -> None:
+        """Release reserved idempotency key without storing response."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Flush and close database."""
+        pass
+
 
 class BaseBell(object):
     """Bell implementation."""
@@ -318,11 +642,43 @@ class BaseBell(object):
     def __init__(self, database: BaseStorage) -> None:
         """Initialize with database."""
         self.database = database
+        self._listeners: List[Callable[[RingEvent, BellResource], None]] = list()
+
+    def add_listener(self, listener: Callable[[RingEvent, BellResource], None]) -> None:
+        """Add listener of ring events (called with the event and the rung resource)."""
+        self._listeners.append(listener)
+
+    def _ring_finished(self, event: RingEvent, resource: BellResource) -> None:
+        """Notify ring event to listeners."""
+        for f in self._listeners:
+            try:
+                f(event, resource)
+            except Exception as ex:
+                logging.error("Error in notifying ring of '{}' ({}).".format(event.token, ex))
+
+    def check(self, resource: Optional[BellResource]=None) -> None:
+        """Check if bell can be rung (by resource) now.
+
+        Raise InvalidResourceOperationError if not.
+        """
+        pass
 
     def ring(self, resource: BellResource) -> None:
         """Ring bell and notify result to the resource."""
         raise NotImplementedError
 
+    def attach(self, key: str) -> Optional[Tuple[BellResource, Awaitable[bool]]]:
+        """Return resource and its result (True if succeeded) if it can be coalesced."""
+        return None
+
+    def hold(self, until: Awaitable) -> None:
+        """Do not start ringing until `until` is done."""
+        pass
+
+    async def close(self, timeout: float) -> None:
+        """Refuse new rings and finish (or fail after `timeout` seconds) accepted rings."""
+        pass
+
 
 async def init_storage_with_sample_data(storage: BaseStorage):
     samples = {"00000000-0000-0000-0000-000000000000":
@@ -350,4 +706,5 @@ async def init_storage_with_sample_data(storage: BaseStorage):
             if not c.resource:
                 await storage.create_resource(v)
             else:
+                v.version = c.resource.version
                 c.resource = v
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Redis infrastracture module of maruberu."""
+
+from __future__ import annotations
+
+import asyncio
+from bisect import bisect
+from datetime import datetime
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import redis
+
+from tornado import ioloop
+from tornado.options import options
+
+from . import metrics
+from . import tracing
+from .models import BaseContext, BaseStorage, BellResource, DataBaseAddress, RingEvent
+from .models import RingSchedule, VersionConflictError
+from .token_filter import CountingBloomFilter
+
+
+class HashRing(object):
+    """Consistent hash ring which maps key to node index."""
+
+    REPLICAS = 160
+
+    def __init__(self, nodes: List[str]) -> None:
+        """Initialize with node names (the index of name is returned by `get`)."""
+        points = sorted((self._hash("{}#{}".format(name, x)), i)
+                        for i, name in enumerate(nodes) for x in range(self.REPLICAS))
+        self._points = [x for x, _ in points]
+        self._nodes = [i for _, i in points]
+        self._single = len(nodes) == 1
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get(self, key: str) -> int:
+        """Return node index of key."""
+        if self._single:
+            return 0
+        return self._nodes[bisect(self._points, self._hash(key)) % len(self._points)]
+
+
+class RedisContext(BaseContext):
+    """With-statement context which processes RedisStorage with specified resource."""
+
+    def __init__(self, resource: BellResource,
+                 client: Optional[redis.StrictRedis]=None, lock: Optional[str]=None,
+                 storage: Optional[RedisStorage]=None) -> None:
+        """Initialize with BellResource, Redis client of the shard, lock key and storage."""
+        super().__init__(resource)
+        self._client = client
+        self._lock = lock
+        self._storage = storage
+
+    async def __aenter__(self):
+        """Enter context with resource."""
+        return self
+
+    async def __aexit__(self, ex_type, ex_value, trace):
+        """Write back resource and release lock."""
+        ex = ex_type or ex_value or trace
+        if self._lock:
+            try:
+                if not ex:
+                    self._storage._compare_and_set(self._client, self.resource)
+            finally:
+                self._client.delete(self._lock)
+        return not ex
+
+
+class RedisStorage(BaseStorage):
+    """Database implementation with Redis.
+
+    Records are sharded over Redis servers by consistent hashing on uuid. Each record,
+    its lock key and its entry of created_at index are stored in the same shard, and
+    listings are merged from all shards.
+
+    Snapshot reads and listings go to a healthy replica of the shard if configured, and
+    locks and writes always go to the primary. Replicas are checked periodically, and a
+    replica which is down or lags more than `database_replica_max_lag` seconds is not
+    used until it recovers.
+
+    Ring events are appended to capped streams of all events and events of each token in
+    the shard of the token, and queried by range of stream ID (time of appending).
+
+    If `filter_capacity` is positive, tokens are also kept in CountingBloomFilter which is
+    built from created_at index on startup (and every `filter_rebuild_interval` seconds),
+    and unknown tokens are answered without lock and database access. Tokens created by
+    other processes are added from the index every `filter_sync_interval` seconds, so they
+    are unknown to this process until then. Tokens deleted by other processes are kept
+    until the next build (which only costs database access).
+    """
+
+    SHARED = True
+    LOCK_LIMIT = 10
+    SLEEP_TIME = 0.1
+    FETCH_COUNT = 100
+    SCHEDULE_KEY = "schedule"
+    INDEX_KEY = "index.created_at"
+    RESPONSE_PREFIX = "idempotency."
+    FILTER_SYNC_MARGIN = 10
+    EVENT_KEY = "events"
+    CAS_SCRIPT = """
+        local current = redis.call('GET', KEYS[1])
+        if not current then
+            return false
+        end
+        if (cjson.decode(current)['version'] or 0) ~= tonumber(ARGV[1]) then
+            return current
+        end
+        redis.call('SET', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, addr: DataBaseAddress,
+                 shards: Optional[List[DataBaseAddress]]=None,
+                 replicas: Optional[List[List[DataBaseAddress]]]=None,
+                 check_interval: int=0, max_events: int=10000,
+                 filter_capacity: int=0, filter_error_rate: float=0.001,
+                 filter_rebuild_interval: int=0, filter_sync_interval: float=1.0) -> None:
+        """Initialize with database address (or addresses of all shards and replicas).
+
+        Replicas are checked every `check_interval` seconds if it is positive.
+        """
+        super().__init__(addr)
+        self.shard_addrs = shards or [addr]
+        self.shards = [redis.StrictRedis(host=x.host, port=x.port, db=x.db)
+                       for x in self.shard_addrs]
+        self.replica_addrs = [(replicas[i] if replicas and i < len(replicas) else [])
+                              for i in range(len(self.shards))]
+        self.replicas = [[redis.StrictRedis(host=x.host, port=x.port, db=x.db) for x in y]
+                         for y in self.replica_addrs]
+        self._healthy = [[False] * len(x) for x in self.replicas]
+        self._next_replica = [0] * len(self.shards)
+        self._ring = HashRing([x.location() for x in self.shard_addrs])
+        self._cas = self.shards[0].register_script(self.CAS_SCRIPT)
+        self._index_checked = False
+        self._max_events = max_events
+        self._filter: Optional[CountingBloomFilter] = None
+        self._filter_capacity = filter_capacity
+        self._filter_error_rate = filter_error_rate
+        self._filter_recent: Dict[str, float] = dict()
+        self._filter_synced_at = 0.0
+        if filter_capacity > 0:
+            ioloop.IOLoop.current().add_callback(self.rebuild_filter)
+            if filter_rebuild_interval > 0:
+                ioloop.PeriodicCallback(self.rebuild_filter,
+                                        filter_rebuild_interval * 1000).start()
+            if filter_sync_interval > 0:
+                ioloop.PeriodicCallback(self.sync_filter, filter_sync_interval * 1000).start()
+        if check_interval > 0 and any(self.replicas):
+            ioloop.IOLoop.current().add_callback(self.check_replicas)
+            ioloop.PeriodicCallback(self.check_replicas, check_interval * 1000).start()
+
+    @classmethod
+    def from_options(cls, addr: DataBaseAddress) -> RedisStorage:
+        """Create database with addresses in `database` and `database_replicas` options.
+
+        Shards are separated by comma, and replicas of each shard are separated by "|".
+        """
+        shards = DataBaseAddress.parse_list(options.database)
+        replicas = [DataBaseAddress.parse_list(x.replace("|", ","))
+                    for x in options.database_replicas.split(",") if x.strip()]
+        return cls(shards[0], shards, replicas, options.database_replica_check_interval,
+                   options.ring_history_size,
+                   options.token_filter_capacity if options.token_filter else 0,
+                   options.token_filter_error_rate, options.token_filter_rebuild_interval,
+                   options.token_filter_sync_interval)
+
+    def rebuild_filter(self) -> None:
+        """Build token filter from created_at index of all shards."""
+        start = time.perf_counter()
+        synced = time.time()
+        recent: Dict[str, float] = dict()
+        try:
+            self._check_index()
+            f = CountingBloomFilter(self._filter_capacity, self._filter_error_rate)
+            for shard in self.shards:
+                for x, score in shard.zscan_iter(self.INDEX_KEY, count=self.FETCH_COUNT):
+                    f.add(x.decode())
+                    if score >= synced - self.FILTER_SYNC_MARGIN:
+                        recent[x.decode()] = score
+        except Exception as ex:
+            logging.error("Error in building token filter ({}).".format(ex))
+            self._filter = None
+            return
+        self._filter, self._filter_recent, self._filter_synced_at = f, recent, synced
+        logging.info("Token filter was built in {:.3f} sec.".format(time.perf_counter() - start))
+
+    def sync_filter(self) -> None:
+        """Add tokens created since the last build or sync to token filter.
+
+        Tokens created within `FILTER_SYNC_MARGIN` seconds before are read again (for
+        delay of writes and clock skew between processes), but added only once.
+        """
+        if self._filter is None:
+            return
+        synced = time.time()
+        try:
+            created = [(x.decode(), score) for shard in self.shards
+                       for x, score in shard.zrangebyscore(
+                           self.INDEX_KEY, self._filter_synced_at - self.FILTER_SYNC_MARGIN,
+                           "+inf", withscores=True)]
+        except redis.RedisError as ex:
+            logging.warning("Error in syncing token filter ({}).".format(ex))
+            return
+        for key, score in created:
+            if key not in self._filter_recent:
+                self._filter.add(key)
+            self._filter_recent[key] = score
+        self._filter_recent = {k: v for k, v in self._filter_recent.items()
+                               if v >= synced - self.FILTER_SYNC_MARGIN}
+        self._filter_synced_at = synced
+
+    def _may_exist(self, key: str) -> bool:
+        """Check if key may exist by token filter (True if filter is not built)."""
+        if self._filter is None or key in self._filter:
+            return True
+        metrics.TOKEN_FILTER_REJECTED_TOTAL.labels().inc()
+        return False
+
+    def _set_healthy(self, index: int, replica: int, healthy: bool) -> None:
+        addr = self.replica_addrs[index][replica].location()
+        if healthy != self._healthy[index][replica]:
+            logging.warning("Replica '{}' is {}.".format(
+                addr, "available" if healthy else "unavailable"))
+        self._healthy[index][replica] = healthy
+        metrics.REDIS_REPLICA_HEALTHY.labels(addr).set(int(healthy))
+
+    def check_replicas(self) -> None:
+        """Check if each replica is linked to its primary and does not lag too much."""
+        for i, group in enumerate(self.replicas):
+            for j, replica in enumerate(group):
+                try:
+                    info = replica.info("replication")
+                    lag = int(info.get("master_last_io_seconds_ago", -1))
+                    healthy = (info.get("role") == "slave" and
+                               info.get("master_link_status") == "up" and lag >= 0 and
+                               (options.database_replica_max_lag <= 0 or
+                                lag <= options.database_replica_max_lag))
+                except redis.RedisError as ex:
+                    logging.warning("Error in checking replica '{}' ({}).".format(
+                        self.replica_addrs[i][j].location(), ex))
+                    healthy = False
+                self._set_healthy(i, j, healthy)
+
+    def _read(self, index: int, f: Callable[[redis.StrictRedis], object]):
+        """Call `f` with healthy replica of shard in turn (or primary if there is none)."""
+        group = self.replicas[index]
+        for _ in range(len(group)):
+            j = self._next_replica[index] = (self._next_replica[index] + 1) % len(group)
+            if not self._healthy[index][j]:
+                continue
+            try:
+                return f(group[j])
+            except redis.RedisError as ex:
+                logging.warning("Error in reading replica '{}' ({}).".format(
+                    self.replica_addrs[index][j].location(), ex))
+                self._set_healthy(index, j, False)
+        return f(self.shards[index])
+
+    def get_shard(self, key: str) -> redis.StrictRedis:
+        """Return Redis client of the shard which has key."""
+        return self.shards[self._ring.get(key)]
+
+    def _check_index(self) -> None:
+        """Build created_at index from resource records if shard has no index."""
+        if self._index_checked:
+            return
+        for shard in self.shards:
+            if shard.exists(self.INDEX_KEY):
+                continue
+            keys = [x for x in shard.scan_iter(count=self.FETCH_COUNT)
+                    if not x.startswith(b"lock.") and not x.startswith(b"index.") and
+                    not x.startswith(self.RESPONSE_PREFIX.encode()) and
+                    not x.startswith(self.EVENT_KEY.encode()) and
+                    x != self.SCHEDULE_KEY.encode()]
+            for x in range(0, len(keys), self.FETCH_COUNT):
+                chunk = keys[x:x + self.FETCH_COUNT]
+                resources = [BellResource.from_dict(json.loads(y))
+                             for y in shard.mget(chunk) if y]
+                if resources:
+                    shard.zadd(self.INDEX_KEY, {r.uuid: r.created_at.timestamp()
+                                                for r in resources})
+        self._index_checked = True
+
+    async def _acquire_lock(self, shard: redis.StrictRedis, lock: str) -> None:
+        """Wait for lock key and set its expiration."""
+        start = time.perf_counter()
+        with tracing.span("lock_wait"):
+            while shard.setnx(lock, datetime.now().timestamp()) == 0:
+                await asyncio.sleep(self.SLEEP_TIME)
+            shard.expire(lock, self.LOCK_LIMIT)
+        metrics.STORAGE_LOCK_WAIT_SECONDS.labels(type(self).__name__).observe(
+            time.perf_counter() - start)
+
+    @metrics.observe_storage("get_resource_context")
+    async def get_resource_context(self, key: str) -> RedisContext:
+        """Get resource from database and return the resource wrapped with RedisContext."""
+        if not self._may_exist(key):
+            return RedisContext(None)
+        shard = self.get_shard(key)
+        lock = "lock." + key
+        await self._acquire_lock(shard, lock)
+        resource = shard.get(key)
+        if resource:
+            return RedisContext(BellResource.from_dict(json.loads(resource)), shard, lock,
+                                self)
+        else:
+            shard.delete(lock)
+            return RedisContext(None)
+
+    @metrics.observe_storage("get_resource")
+    async def get_resource(self, key: str) -> Optional[BellResource]:
+        """Get snapshot of resource from database without lock."""
+        if not self._may_exist(key):
+            return None
+        resource = self._read(self._ring.get(key), lambda x: x.get(key))
+        return BellResource.from_dict(json.loads(resource)) if resource else None
+
+    def _compare_and_set(self, shard: redis.StrictRedis, obj: BellResource) -> None:
+        record = obj.to_dict()
+        record["version"] = obj.version + 1
+        result = self._cas(keys=[obj.uuid], args=[obj.version, json.dumps(record)],
+                           client=shard)
+        if result != 1:
+            if result is None:
+                raise KeyError(obj.uuid)
+            raise VersionConflictError(BellResource.from_dict(json.loads(result)))
+        obj.version += 1
+        self._changed(obj.uuid, obj)
+
+    @metrics.observe_storage("update_resource")
+    async def update_resource(self, obj: BellResource) -> None:
+        """Update resource record if its version is not changed (see `BaseStorage`)."""
+        if not self._may_exist(obj.uuid):
+            raise KeyError(obj.uuid)
+        self._compare_and_set(self.get_shard(obj.uuid), obj)
+
+    def _get_index_page(self, shard: redis.StrictRedis,
+                        start: Optional[Tuple[float, str]],
+                        limit: Optional[int]) -> List[Tuple[float, str]]:
+        """Get (created_at, uuid) from index of shard in descending order."""
+        if start is None:
+            items = shard.zrevrange(self.INDEX_KEY, 0, limit - 1 if limit else -1,
+                                    withscores=True)
+        else:
+            page = dict()
+            if limit:
+                page = {"start": 0, "num": limit + shard.zcount(self.INDEX_KEY,
+                                                                start[0], start[0])}
+            items = shard.zrevrangebyscore(self.INDEX_KEY, start[0], "-inf",
+                                           withscores=True, **page)
+        items = [(score, key.decode()) for key, score in items]
+        if start is not None:
+            items = [x for x in items if x <= start]
+        return items[:limit] if limit else items
+
+    @metrics.observe_storage("get_all_resources")
+    def get_all_resources(self,
+                          cond: Optional[List]=None,
+                          start_key: Optional[str]=None,
+                          limit: Optional[int]=None) -> List[BellResource]:
+        """Get resource list from database (see `BaseStorage.get_all_resources`)."""
+        self._check_index()
+        start = None
+        if start_key is not None:
+            i = self._ring.get(start_key)
+            score = self._read(i, lambda x: x.zscore(self.INDEX_KEY, start_key))
+            if score is None:
+                score = self.shards[i].zscore(self.INDEX_KEY, start_key)
+            if score is None:
+                raise KeyError
+            start = (score, start_key)
+        pages = [self._read(i, lambda x: self._get_index_page(x, start, limit))
+                 for i in range(len(self.shards))]
+        keys = [x for _, x in heapq.merge(*pages, reverse=True)][:limit]
+        return self.get_resources(keys)
+
+    @metrics.observe_storage("get_resources")
+    def get_resources(self, keys: Sequence[str]) -> List[BellResource]:
+        """Get resources of keys (see `BaseStorage.get_resources`)."""
+        groups: Dict[int, List[str]] = dict()
+        for key in keys:
+            groups.setdefault(self._ring.get(key), list()).append(key)
+        records: Dict[str, BellResource] = dict()
+        for i, group in groups.items():
+            for x in range(0, len(group), self.FETCH_COUNT):
+                chunk = group[x:x + self.FETCH_COUNT]
+                for y in self._read(i, lambda z: z.mget(chunk)):
+                    if y:
+                        r = BellResource.from_dict(json.loads(y))
+                        records[r.uuid] = r
+        return [records[x] for x in keys if x in records]
+
+    @metrics.observe_storage("create_resource")
+    async def create_resource(self, obj: BellResource) -> None:
+        """Create resource record."""
+        shard = self.get_shard(obj.uuid)
+        lock = "lock." + obj.uuid
+        await self._acquire_lock(shard, lock)
+        self._check_index()
+        setnx = shard.setnx(obj.uuid, json.dumps(obj.to_dict()))
+        if setnx:
+            shard.zadd(self.INDEX_KEY, {obj.uuid: obj.created_at.timestamp()})
+            if self._filter is not None:
+                self._filter.add(obj.uuid)
+                self._filter_recent[obj.uuid] = obj.created_at.timestamp()
+            self._changed(obj.uuid, obj)
+        shard.delete(lock)
+        if not setnx:
+            raise ValueError
+
+    @metrics.observe_storage("delete_resource")
+    async def delete_resource(self, key: str) -> BellResource:
+        """Delete resource record."""
+        if not self._may_exist(key):
+            raise KeyError
+        shard = self.get_shard(key)
+        lock = "lock." + key
+        await self._acquire_lock(shard, lock)
+        resource = shard.get(key)
+        if resource:
+            with shard.pipeline() as pipe:
+                pipe.delete(key)
+                pipe.zrem(self.INDEX_KEY, key)
+                pipe.delete(lock)
+                pipe.execute()
+            if self._filter is not None:
+                self._filter.remove(key)
+            self._changed(key, None)
+            return BellResource.from_dict(json.loads(resource))
+        else:
+            shard.delete(lock)
+            raise KeyError
+
+    @metrics.observe_storage("get_all_schedules")
+    def get_all_schedules(self) -> List[RingSchedule]:
+        """Get schedule list from database in order of fire time."""
+        return list(sorted([RingSchedule.from_dict(json.loads(x))
+                            for shard in self.shards for x in shard.hvals(self.SCHEDULE_KEY)],
+                           key=lambda x: x.timestamp()))
+
+    @metrics.observe_storage("create_schedule")
+    async def create_schedule(self, obj: RingSchedule) -> None:
+        """Create schedule record."""
+        if not self.get_shard(obj.uuid).hsetnx(self.SCHEDULE_KEY, obj.uuid,
+                                               json.dumps(obj.to_dict())):
+            raise ValueError
+
+    @metrics.observe_storage("delete_schedule")
+    async def delete_schedule(self, key: str) -> RingSchedule:
+        """Delete schedule record."""
+        with self.get_shard(key).pipeline() as pipe:
+            pipe.hget(self.SCHEDULE_KEY, key)
+            pipe.hdel(self.SCHEDULE_KEY, key)
+            schedule, _ = pipe.execute()
+        if schedule:
+            return RingSchedule.from_dict(json.loads(schedule))
+        else:
+            raise KeyError
+
+    @metrics.observe_storage("append_event")
+    async def append_event(self, obj: RingEvent) -> None:
+        """Append ring event to history."""
+        if self._max_events <= 0:
+            return
+        data = {"event": json.dumps(obj.to_dict())}
+        with self.get_shard(obj.token).pipeline() as pipe:
+            for key in (self.EVENT_KEY, "{}.{}".format(self.EVENT_KEY, obj.token)):
+                pipe.xadd(key, data, maxlen=self._max_events, approximate=True)
+            pipe.execute()
+
+    @metrics.observe_storage("get_events")
+    def get_events(self, token: Optional[str]=None,
+                   since: Optional[datetime]=None, until: Optional[datetime]=None,
+                   limit: Optional[int]=None) -> List[RingEvent]:
+        """Get ring events (see `BaseStorage.get_events`)."""
+        key = self.EVENT_KEY if token is None else "{}.{}".format(self.EVENT_KEY, token)
+        end = int(until.timestamp() * 1000) if until else "+"
+        begin = int(since.timestamp() * 1000) if since else "-"
+        pages = [[(tuple(int(y) for y in x.split(b"-")), data[b"event"])
+                  for x, data in self._read(i, lambda z: z.xrevrange(key, end, begin, limit))]
+                 for i in ([self._ring.get(token)] if token else range(len(self.shards)))]
+        return [RingEvent.from_dict(json.loads(x))
+                for _, x in itertools.islice(heapq.merge(*pages, reverse=True), limit)]
+
+    @metrics.observe_storage("reserve_response")
+    async def reserve_response(self, key: str, expire: int) -> Optional[dict]:
+        """Reserve idempotency key (see `BaseStorage.reserve_response`)."""
+        shard = self.get_shard(key)
+        while not shard.set(self.RESPONSE_PREFIX + key, "{}", nx=True, ex=expire):
+            response = shard.get(self.RESPONSE_PREFIX + key)
+            if response:
+                return json.loads(response)
+        return None
+
+    @metrics.observe_storage("store_response")
+    async def store_response(self, key: str, response: dict, expire: int) -> None:
+        """Store response with reserved idempotency key."""
+        self.get_shard(key).set(self.RESPONSE_PREFIX + key, json.dumps(response), ex=expire)
+
+    @metrics.observe_storage("release_response")
+    async def release_response(self, key: str) -> None:
+        """Release reserved idempotency key without storing response."""
+        self.get_shard(key).delete(self.RESPONSE_PREFIX + key)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Resource table module of maruberu.
+
+ResourceTable mirrors attributes of all resources in typed arrays (one array per
+attribute) and is kept in sync by storage change listeners, so statistics and filters
+are computed in one pass over compact columns without creating BellResource objects.
+
+The table is built at startup and only follows changes made by this process, so it
+should be rebuilt periodically if other processes share the storage (env="REDIS").
+"""
+
+from __future__ import annotations
+
+from array import array
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from tornado import ioloop
+
+from .models import BaseStorage, BellResource, BellResourceStatus
+
+
+class ResourceTable(object):
+    """Columnar mirror of resource attributes."""
+
+    FLAGS = {"sticky": 1, "api": 2, "coalesce": 4, "pattern": 8}
+    FILTERS = ("valid", "unused", "using", "used", "before", "expired", "expiring", "failing")
+
+    def __init__(self) -> None:
+        """Initialize with no resources."""
+        self.clear()
+
+    def clear(self) -> None:
+        """Remove all rows."""
+        self.keys: List[str] = list()
+        self._pos: Dict[str, int] = dict()
+        self.status = array("b")
+        self.not_before = array("d")
+        self.not_after = array("d")
+        self.created_at = array("d")
+        self.flags = array("B")
+        self.failed_count = array("l")
+
+    @classmethod
+    def attach(cls, storage: BaseStorage, rebuild_interval: int=0) -> ResourceTable:
+        """Create table with all resources in storage and follow its changes.
+
+        The table is rebuilt from storage every `rebuild_interval` seconds if it is positive.
+        """
+        table = cls()
+        table.rebuild(storage)
+        storage.add_listener(table.update)
+        if rebuild_interval > 0:
+            ioloop.PeriodicCallback(lambda: table.rebuild(storage),
+                                    rebuild_interval * 1000).start()
+        return table
+
+    def rebuild(self, storage: BaseStorage) -> None:
+        """Replace all rows with resources in storage (keep rows on error)."""
+        start = time.perf_counter()
+        try:
+            resources = storage.get_all_resources()
+        except Exception as ex:
+            logging.error("Error in building resource table ({}).".format(ex))
+            return
+        self.load(resources)
+        logging.info("Resource table was built in {:.3f} sec.".format(
+            time.perf_counter() - start))
+
+    def __len__(self) -> int:
+        """Return number of resources."""
+        return len(self.keys)
+
+    def _columns(self) -> List[array]:
+        return [self.status, self.not_before, self.not_after, self.created_at, self.flags,
+                self.failed_count]
+
+    def _row(self, resource: BellResource) -> tuple:
+        flags = 0
+        for name, bit in self.FLAGS.items():
+            if getattr(resource, name):
+                flags |= bit
+        return (resource._status.value,
+                resource.not_before.timestamp() if resource.not_before else float("-inf"),
+                resource.not_after.timestamp() if resource.not_after else float("inf"),
+                resource.created_at.timestamp(),
+                flags,
+                resource._failed_count)
+
+    def load(self, resources: Iterable[BellResource]) -> None:
+        """Replace all rows with resources."""
+        self.clear()
+        for x in resources:
+            self.update(x.uuid, x)
+
+    def update(self, key: str, resource: Optional[BellResource]) -> None:
+        """Insert or update row of resource (or remove row if resource is None)."""
+        pos = self._pos.get(key)
+        if resource is not None:
+            row = self._row(resource)
+            if pos is None:
+                self._pos[key] = len(self.keys)
+                self.keys.append(key)
+                for column, value in zip(self._columns(), row):
+                    column.append(value)
+            else:
+                for column, value in zip(self._columns(), row):
+                    column[pos] = value
+        elif pos is not None:
+            last = len(self.keys) - 1
+            for column in self._columns():
+                column[pos] = column[last]
+                column.pop()
+            self.keys[pos] = self.keys[last]
+            self._pos[self.keys[pos]] = pos
+            self.keys.pop()
+            del self._pos[key]
+
+    def stats(self, now: float, soon: float) -> dict:
+        """Count resources by status, period and flags at `now` (expiring in `soon` sec)."""
+        unused = BellResourceStatus.UNUSED.value
+        used = BellResourceStatus.USED.value
+        status = {x.value: 0 for x in BellResourceStatus}
+        flags = {x: 0 for x in self.FLAGS}
+        valid = before = expired = expiring = failing = 0
+        for s, nb, na, fl, fc in zip(self.status, self.not_before, self.not_after,
+                                     self.flags, self.failed_count):
+            status[s] += 1
+            if now < nb:
+                before += 1
+            elif na < now:
+                expired += 1
+            else:
+                if s == unused:
+                    valid += 1
+                if na <= now + soon and s != used:
+                    expiring += 1
+            if fc:
+                failing += 1
+            if fl:
+                for name, bit in self.FLAGS.items():
+                    if fl & bit:
+                        flags[name] += 1
+        return {"total": len(self.keys),
+                "status": {x.name: status[x.value] for x in BellResourceStatus
+                           if x is not BellResourceStatus.UNDEFINED},
+                "valid": valid, "before": before, "expired": expired,
+                "expiring": expiring, "failing": failing,
+                "flags": flags}
+
+    def _predicate(self, name: str, now: float, soon: float) -> Callable[..., bool]:
+        unused = BellResourceStatus.UNUSED.value
+        using = BellResourceStatus.USING.value
+        used = BellResourceStatus.USED.value
+        return {"valid": lambda s, nb, na, fc: s == unused and nb <= now <= na,
+                "unused": lambda s, nb, na, fc: s == unused,
+                "using": lambda s, nb, na, fc: s == using,
+                "used": lambda s, nb, na, fc: s == used,
+                "before": lambda s, nb, na, fc: now < nb,
+                "expired": lambda s, nb, na, fc: na < now,
+                "expiring": lambda s, nb, na, fc: (s != used and nb <= now <= na and
+                                                   na <= now + soon),
+                "failing": lambda s, nb, na, fc: fc > 0}[name]
+
+    def select(self, name: str, now: float, soon: float) -> List[str]:
+        """Return keys of resources which match filter (one of `FILTERS`) from newest."""
+        if name not in self.FILTERS:
+            raise ValueError("filter must be one of {} (actual: {})".format(self.FILTERS, name))
+        f = self._predicate(name, now, soon)
+        rows = [(ca, k) for k, s, nb, na, ca, fc in zip(self.keys, self.status, self.not_before,
+                                                        self.not_after, self.created_at,
+                                                        self.failed_count)
+                if f(s, nb, na, fc)]
+        return [k for _, k in sorted(rows, reverse=True)]
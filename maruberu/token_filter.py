@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Token filter module of maruberu.
+
+Counting Bloom filter answers "definitely not exists" for unknown tokens without asking
+the database. Each counter is one byte, and saturated counters are never decremented.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+from typing import Iterable, Iterator
+
+
+class CountingBloomFilter(object):
+    """Bloom filter which supports removing keys."""
+
+    MAX_COUNT = 255
+
+    def __init__(self, capacity: int, error_rate: float=0.001) -> None:
+        """Initialize with expected number of keys and false positive rate."""
+        if capacity <= 0 or not 0 < error_rate < 1:
+            msg = "Expected capacity > 0 and 0 < error_rate < 1, but {}(capacity), {}(error_rate)."
+            raise ValueError(msg.format(capacity, error_rate))
+        self.size = max(1, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._counters = bytearray(self.size)
+
+    @classmethod
+    def from_keys(cls, keys: Iterable[str], capacity: int,
+                  error_rate: float=0.001) -> CountingBloomFilter:
+        """Create filter with keys."""
+        f = cls(capacity, error_rate)
+        for x in keys:
+            f.add(x)
+        return f
+
+    def _indexes(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str) -> None:
+        """Add key."""
+        for i in self._indexes(key):
+            if self._counters[i] < self.MAX_COUNT:
+                self._counters[i] += 1
+
+    def remove(self, key: str) -> None:
+        """Remove key which was added."""
+        for i in self._indexes(key):
+            if 0 < self._counters[i] < self.MAX_COUNT:
+                self._counters[i] -= 1
+
+    def __contains__(self, key: str) -> bool:
+        """Check if key may have been added."""
+        return all(self._counters[i] for i in self._indexes(key))
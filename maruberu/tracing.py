@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tracing module of maruberu.
+
+* off: record nothing (`span` is a shared no-op context).
+* trace: record spans of every request and ring, and write them to `trace_file`.
+* sample: record spans of `trace_sample_rate` of requests, and dump profiler snapshots
+  every `trace_profile_interval` seconds to `trace_file`.
+
+Mode can be changed at runtime with `set_mode`.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import pstats
+import random
+import time
+from typing import List, Optional, Tuple
+import uuid
+
+from tornado import ioloop
+from tornado.options import options
+
+
+MODES = ("off", "trace", "sample")
+
+_mode = "off"
+_current: contextvars.ContextVar = contextvars.ContextVar("maruberu_trace", default=None)
+_output = None
+_profiler_callback: Optional[ioloop.PeriodicCallback] = None
+_null_span = contextlib.nullcontext()
+
+
+class Trace(object):
+    """Timed spans which share a trace ID."""
+
+    __slots__ = ("trace_id", "name", "start", "spans")
+
+    def __init__(self, name: str, trace_id: Optional[str]=None) -> None:
+        """Initialize with trace name and ID (new ID is generated if omitted)."""
+        self.trace_id: str = trace_id or uuid.uuid4().hex
+        self.name: str = name
+        self.start: float = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = list()
+
+    def add(self, name: str, start: float, end: float) -> None:
+        """Record span with perf_counter values."""
+        self.spans.append((name, start - self.start, end - start))
+
+    def to_dict(self) -> dict:
+        """Extract Trace as dict (times in milliseconds)."""
+        return {"trace_id": self.trace_id,
+                "name": self.name,
+                "time": time.time(),
+                "duration": (time.perf_counter() - self.start) * 1000,
+                "spans": [{"name": n, "offset": o * 1000, "duration": d * 1000}
+                          for n, o, d in self.spans]}
+
+
+def get_mode() -> str:
+    """Return current tracing mode."""
+    return _mode
+
+
+def set_mode(mode: str) -> None:
+    """Change tracing mode."""
+    global _mode, _profiler_callback
+    if mode not in MODES:
+        raise ValueError("mode must be one of {} (actual: {})".format(MODES, mode))
+    _mode = mode
+    if _profiler_callback:
+        _profiler_callback.stop()
+        _profiler_callback = None
+    if mode == "sample" and options.trace_profile_interval > 0:
+        _profiler_callback = ioloop.PeriodicCallback(_profile,
+                                                     options.trace_profile_interval * 1000)
+        _profiler_callback.start()
+    logging.info("Tracing mode is '{}'.".format(mode))
+
+
+def start_trace(name: str, trace_id: Optional[str]=None,
+                sampled: bool=False) -> Optional[Trace]:
+    """Start trace in current context if it is enabled (and sampled).
+
+    Set `sampled` to continue trace which was already sampled in another context.
+    """
+    if _mode == "off" or (_mode == "sample" and not sampled and
+                          random.random() >= options.trace_sample_rate):
+        return None
+    trace = Trace(name, trace_id)
+    _current.set(trace)
+    return trace
+
+
+def current() -> Optional[Trace]:
+    """Return trace in current context."""
+    return _current.get()
+
+
+def finish_trace(trace: Optional[Trace]) -> None:
+    """Write trace and detach it from current context."""
+    if trace is None:
+        return
+    if _current.get() is trace:
+        _current.set(None)
+    _write(trace.to_dict())
+
+
+@contextlib.contextmanager
+def _span(trace: Trace, name: str):
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.add(name, start, time.perf_counter())
+
+
+def span(name: str, trace: Optional[Trace]=None):
+    """Return context which records span to trace (or to trace in current context)."""
+    trace = trace or _current.get()
+    if trace is None:
+        return _null_span
+    return _span(trace, name)
+
+
+def _write(obj: dict) -> None:
+    global _output
+    try:
+        if _output is None:
+            _output = open(options.trace_file, "a", buffering=1)
+        _output.write(json.dumps(obj) + "\n")
+    except Exception as ex:
+        logging.error("Error in writing trace ({}).".format(ex))
+
+
+def _profile() -> None:
+    """Profile IOLoop for `trace_profile_duration` seconds and write snapshot."""
+    profiler = cProfile.Profile()
+
+    def dump() -> None:
+        profiler.disable()
+        buf = io.StringIO()
+        pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(30)
+        _write({"name": "profile", "time": time.time(), "stats": buf.getvalue()})
+    try:
+        profiler.enable()
+    except ValueError as ex:
+        logging.warning("Profiler is not available now ({}).".format(ex))
+        return
+    ioloop.IOLoop.current().call_later(options.trace_profile_duration, dump)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Webhook module of maruberu.
+
+Results of rings are posted to `webhook_urls` and `callback_url` of the resource as
+JSON (`{"events": [RingEvent.to_dict(), ...]}`). Events are put into a bounded queue
+without waiting, collected into batches of each URL (up to `webhook_batch_size` events
+or `webhook_batch_interval` seconds), and posted by a shared AsyncHTTPClient. Failed
+batches are retried with exponential backoff, and batches which were given up (or events
+which overflowed the queue) are appended to `webhook_dead_letter` as JSON lines.
+
+On shutdown, `close` waits for queued events to be delivered and writes the rest to the
+dead letter file.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+import json
+import logging
+import random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from tornado import httpclient
+from tornado import ioloop
+from tornado.options import options
+
+from . import metrics
+from .models import BaseBell, BellResource, RingEvent
+
+
+class WebhookDispatcher(object):
+    """Deliverer of ring events to callback URLs."""
+
+    def __init__(self, urls: Sequence[str]=(), queue_size: int=1000, batch_size: int=50,
+                 batch_interval: float=1.0, max_retries: int=5, retry_delay: float=1.0,
+                 timeout: float=10.0, max_clients: int=10,
+                 dead_letter: Optional[str]=None) -> None:
+        """Initialize with global URLs and delivery parameters, and start delivery."""
+        self.urls = [x for x in urls if x]
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.dead_letter = dead_letter
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._slots = asyncio.Semaphore(max(1, max_clients))
+        self._client = httpclient.AsyncHTTPClient(force_instance=True,
+                                                  max_clients=max(1, max_clients))
+        self._delivering = 0
+        self._collected = 0
+        self._closed = False
+        self._dispatcher: Optional[asyncio.Task] = None
+        ioloop.IOLoop.current().add_callback(self.dispatch)
+
+    @classmethod
+    def from_options(cls) -> WebhookDispatcher:
+        """Create dispatcher with webhook options."""
+        return cls([x.strip() for x in options.webhook_urls.split(",")],
+                   options.webhook_queue_size, options.webhook_batch_size,
+                   options.webhook_batch_interval, options.webhook_max_retries,
+                   options.webhook_retry_delay, options.webhook_timeout,
+                   options.webhook_max_clients, options.webhook_dead_letter or None)
+
+    @classmethod
+    def attach(cls, bell: BaseBell) -> WebhookDispatcher:
+        """Create dispatcher with options and follow ring events of bell."""
+        dispatcher = cls.from_options()
+        bell.add_listener(dispatcher.put)
+        return dispatcher
+
+    def put(self, event: RingEvent, resource: Optional[BellResource]=None) -> None:
+        """Queue event for global URLs and callback URL of resource (never wait)."""
+        body = event.to_dict()
+        urls = self.urls + ([resource.callback_url]
+                            if resource and resource.callback_url else [])
+        for url in urls:
+            try:
+                self._queue.put_nowait((url, body))
+            except asyncio.QueueFull:
+                metrics.WEBHOOK_EVENTS_TOTAL.labels("dropped").inc()
+                ioloop.IOLoop.current().add_callback(self._write_dead_letter, url, [body],
+                                                     "queue is full")
+        metrics.WEBHOOK_QUEUE_DEPTH.labels().set(self._queue.qsize())
+
+    async def _collect(self) -> Dict[str, List[dict]]:
+        """Wait for events and collect them by URL for `batch_interval` seconds."""
+        url, body = await self._queue.get()
+        batches = {url: [body]}
+        count = self._collected = 1
+        deadline = ioloop.IOLoop.current().time() + self.batch_interval
+        while count < self.batch_size:
+            if self._queue.empty():
+                timeout = deadline - ioloop.IOLoop.current().time()
+                if timeout <= 0:
+                    break
+                try:
+                    url, body = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                url, body = self._queue.get_nowait()
+            batches.setdefault(url, list()).append(body)
+            count = self._collected = count + 1
+        metrics.WEBHOOK_QUEUE_DEPTH.labels().set(self._queue.qsize())
+        return batches
+
+    async def dispatch(self) -> None:
+        """Post batches of queued events (at most `max_clients` batches at once)."""
+        self._dispatcher = asyncio.current_task()
+        while True:
+            try:
+                batches = await self._collect()
+                for url, events in batches.items():
+                    if self._closed:
+                        self._write_dead_letter(url, events, "server is shutting down")
+                        continue
+                    await self._slots.acquire()
+                    self._delivering += 1
+                    ioloop.IOLoop.current().add_callback(self._deliver, url, events)
+            except Exception as ex:
+                logging.error("Error in dispatching webhook ({}).".format(ex))
+            finally:
+                self._collected = 0
+
+    async def _deliver(self, url: str, events: List[dict]) -> None:
+        """Post events to URL with retries."""
+        try:
+            error = await self._post(url, events)
+            if error is None:
+                metrics.WEBHOOK_EVENTS_TOTAL.labels("delivered").inc(len(events))
+                return
+            metrics.WEBHOOK_EVENTS_TOTAL.labels("failed").inc(len(events))
+            logging.error("Webhook to '{}' was given up ({}).".format(url, error))
+            self._write_dead_letter(url, events, error)
+        finally:
+            self._delivering -= 1
+            self._slots.release()
+
+    async def _post(self, url: str, events: List[dict]) -> Optional[str]:
+        """Post events and return the last error (None if succeeded)."""
+        body = json.dumps({"events": events})
+        error = None
+        for i in range(self.max_retries + 1):
+            if i and self._closed:
+                break
+            if i:
+                delay = self.retry_delay * 2 ** (i - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                metrics.WEBHOOK_EVENTS_TOTAL.labels("retried").inc(len(events))
+            try:
+                await self._client.fetch(url, method="POST", body=body,
+                                         headers={"Content-Type": "application/json"},
+                                         request_timeout=self.timeout)
+                return None
+            except httpclient.HTTPClientError as ex:
+                error = "HTTP {}".format(ex.code)
+                if 400 <= ex.code < 500 and ex.code not in (408, 429):
+                    break
+            except Exception as ex:
+                error = str(ex) or type(ex).__name__
+        return error
+
+    def _write_dead_letter(self, url: str, events: List[dict], error: str) -> None:
+        """Append undelivered events to dead letter file."""
+        if not self.dead_letter:
+            return
+        try:
+            with open(self.dead_letter, "a") as f:
+                f.write(json.dumps({"url": url, "error": error,
+                                    "time": datetime.now().isoformat(),
+                                    "events": events}, ensure_ascii=False) + "\n")
+        except Exception as ex:
+            logging.error("Error in writing dead letter '{}' ({}).".format(self.dead_letter, ex))
+
+    def pending(self) -> Tuple[int, int]:
+        """Return numbers of queued events and batches being delivered."""
+        return self._queue.qsize() + self._collected, self._delivering
+
+    async def _wait(self, timeout: float) -> bool:
+        """Wait until no event is pending for `timeout` seconds at most."""
+        deadline = ioloop.IOLoop.current().time() + timeout
+        while any(self.pending()):
+            if ioloop.IOLoop.current().time() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def close(self, timeout: float) -> None:
+        """Wait for queued events to be delivered, and write the rest to dead letter.
+
+        Failed batches are not retried after `timeout` seconds.
+        """
+        finished = await self._wait(timeout)
+        self._closed = True
+        if not finished:
+            rest: Dict[str, List[dict]] = dict()
+            while not self._queue.empty():
+                url, body = self._queue.get_nowait()
+                rest.setdefault(url, list()).append(body)
+            for url, events in rest.items():
+                logging.error("{} events to '{}' were not delivered.".format(len(events), url))
+                self._write_dead_letter(url, events, "server is shutting down")
+            await self._wait(self.batch_interval + self.timeout)
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+        self._client.close()
@@ -51,7 +51,7 @@ def main() -> None:
               "Programming Language :: Python :: 3.7",
               "Framework :: Tornado",
           ],
-          packages=find_packages(),
+          packages=find_packages(exclude=["benchmarks"]),
           entry_points="""
           [console_scripts]
           maruberu = maruberu.main:main